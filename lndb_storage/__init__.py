@@ -6,6 +6,16 @@ File → memory:
    :toctree: .
 
    h5ad_to_anndata
+   CacheManager
+
+Subset files:
+
+.. autosummary::
+   :toctree: .
+
+   subset
+   subset_iter
+   write_adatas_zarr
 
 Store files:
 
@@ -22,8 +32,9 @@ __version__ = "0.4a1"  # denote a release candidate for 0.1.0 with 0.1rc1
 from lamindb_setup.dev.upath import UPath
 from lamindb_setup.dev.upath import infer_filesystem as _infer_filesystem
 
+from ._cache import CacheManager
 from ._file import delete_storage, load_to_memory, store_object
 from ._h5ad import h5ad_to_anndata
 from ._images import store_png
-from ._subset import subset
-from ._zarr import read_adata_zarr, write_adata_zarr
+from ._subset import subset, subset_iter
+from ._zarr import read_adata_zarr, write_adata_zarr, write_adatas_zarr
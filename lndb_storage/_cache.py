@@ -0,0 +1,306 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterator, Optional, Union
+
+from lamin_logger import logger
+from lamindb_setup import settings
+from lamindb_setup.dev.upath import UPath, infer_filesystem
+
+from .object._metadata_cache import _storage_version
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None  # type: ignore
+
+# the default byte budget of the cache, None means no limit
+MAX_CACHE_BYTES: Optional[int] = None
+
+_INDEX_FILE = "index.json"
+# locks between threads of a process if fcntl is not available
+_THREAD_LOCKS: Dict[str, Lock] = {}
+_THREAD_LOCKS_LOCK = Lock()
+
+
+def _md5(filepath: Path) -> bytes:
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            md5.update(block)
+    return md5.digest()
+
+
+def _same_checksum(localpath: Path, info: dict) -> Optional[bool]:
+    """Compare the md5 hash of a local file to the hash of a stored object.
+
+    Returns `None` if the storage doesn't provide an md5 hash for the object.
+    """
+    # only the etags of objects uploaded in one part are md5 hashes
+    etag = str(info.get("ETag", "")).strip('"')
+    if len(etag) == 32 and "-" not in etag:
+        return _md5(localpath).hex() == etag
+    if info.get("md5Hash") is not None:
+        return base64.b64encode(_md5(localpath)).decode() == info["md5Hash"]
+    return None
+
+
+@contextmanager
+def _file_lock(lock_path: Path) -> Iterator[None]:
+    """Exclusive lock shared between processes."""
+    if fcntl is None:
+        with _THREAD_LOCKS_LOCK:
+            lock = _THREAD_LOCKS.setdefault(str(lock_path), Lock())
+        with lock:
+            yield None
+        return None
+    with open(lock_path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield None
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def _try_file_lock(lock_path: Path) -> Iterator[bool]:
+    """Like `_file_lock`, but yields `False` instead of waiting for the lock."""
+    if fcntl is None:
+        with _THREAD_LOCKS_LOCK:
+            lock = _THREAD_LOCKS.setdefault(str(lock_path), Lock())
+        if not lock.acquire(blocking=False):
+            yield False
+            return None
+        try:
+            yield True
+        finally:
+            lock.release()
+        return None
+    with open(lock_path, "a") as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return None
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _path_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def _remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+
+
+class CacheManager:
+    """Local cache of files and directories downloaded from the storage.
+
+    Downloads are deduplicated between processes with file locks,
+    validated against the md5 hashes provided by the storage and
+    invalidated if the stored object changes.
+    The least recently used (`"lru"`) or the least frequently used (`"lfu"`)
+    unpinned entries are evicted if the cache exceeds `max_bytes`.
+
+    Args:
+        cache_dir: The cache directory, defaults to a subdirectory of
+            the cache directory of the current instance.
+        max_bytes: The byte budget, defaults to `MAX_CACHE_BYTES`.
+        policy: The eviction policy, `"lru"` or `"lfu"`.
+        validate: Validate the checksums of downloaded files.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Union[str, Path]] = None,
+        max_bytes: Optional[int] = None,
+        policy: str = "lru",
+        validate: bool = True,
+    ):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"policy should be 'lru' or 'lfu', not {policy}.")
+        if cache_dir is None:
+            cache_dir = Path(settings.instance.storage.cache_dir) / "_lndb_storage"
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes if max_bytes is not None else MAX_CACHE_BYTES
+        self.policy = policy
+        self.validate = validate
+
+    def _key(self, path_str: str) -> str:
+        return hashlib.sha1(path_str.encode()).hexdigest()
+
+    @contextmanager
+    def _index(self) -> Iterator[dict]:
+        """Lock, read and write back the index of the cache."""
+        index_file = self.cache_dir / _INDEX_FILE
+        with _file_lock(self.cache_dir / (_INDEX_FILE + ".lock")):
+            index = {}
+            if index_file.exists():
+                try:
+                    index = json.loads(index_file.read_text())
+                except ValueError:
+                    logger.warning("The cache index is corrupted, resetting it.")
+            yield index
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_file, index_file)
+
+    def _download(self, fs, path_str: str, localpath: Path):
+        tmp_path = localpath.with_name(localpath.name + ".download")
+        _remove(tmp_path)
+        try:
+            if fs.isdir(path_str):
+                fs.get(path_str, str(tmp_path), recursive=True)
+            else:
+                fs.get_file(path_str, str(tmp_path))
+                if self.validate:
+                    self._validate(fs.info(path_str), tmp_path, path_str)
+        except BaseException as e:
+            _remove(tmp_path)
+            raise e
+        _remove(localpath)
+        os.replace(tmp_path, localpath)
+
+    def _validate(self, info: dict, localpath: Path, path_str: str):
+        if info.get("size") is not None and info["size"] != localpath.stat().st_size:
+            raise OSError(f"Size mismatch of the downloaded file {path_str}.")
+        if _same_checksum(localpath, info) is False:
+            raise OSError(f"Checksum mismatch of the downloaded file {path_str}.")
+
+    def get(self, filepath: Union[str, Path, UPath], pin: bool = False) -> Path:
+        """Get the local path of a stored object, download it if needed.
+
+        Local paths are returned as they are.
+        """
+        fs, path_str = infer_filesystem(filepath)
+        if "file" in fs.protocol or "local" in fs.protocol:
+            return Path(path_str)
+
+        suffix = Path(path_str).suffix
+        version = _storage_version(fs, path_str, suffix)
+        key = self._key(path_str)
+        key_dir = self.cache_dir / key
+        key_dir.mkdir(exist_ok=True)
+        localpath = key_dir / Path(path_str.rstrip("/")).name
+
+        # other processes wait here until the download of the same object is done
+        with _file_lock(self.cache_dir / (key + ".lock")):
+            with self._index() as index:
+                entry = index.get(key)
+            # objects without a version can't be checked for changes
+            # and are downloaded only once, like with `cloud_to_local_no_update`
+            is_valid = entry is not None and entry["version"] == version
+            is_valid = is_valid and localpath.exists()
+            if not is_valid:
+                self._download(fs, path_str, localpath)
+
+            with self._index() as index:
+                entry = index.get(key) if is_valid else None
+                if entry is None:
+                    entry = dict(
+                        path=path_str,
+                        size=_path_size(localpath),
+                        version=version,
+                        n_access=0,
+                        pinned=False,
+                    )
+                entry["last_access"] = time.time()
+                entry["n_access"] += 1
+                entry["pinned"] = entry["pinned"] or pin
+                index[key] = entry
+                self._evict(index, exclude=key)
+        return localpath
+
+    def _evict(self, index: dict, exclude: Optional[str] = None):
+        if self.max_bytes is None:
+            return None
+        total = sum(entry["size"] for entry in index.values())
+        if total <= self.max_bytes:
+            return None
+
+        if self.policy == "lru":
+            order = lambda key: index[key]["last_access"]  # noqa: E731
+        else:
+            order = lambda key: (  # noqa: E731
+                index[key]["n_access"],
+                index[key]["last_access"],
+            )
+        candidates = sorted(
+            (key for key in index if key != exclude and not index[key]["pinned"]),
+            key=order,
+        )
+        for key in candidates:
+            if total <= self.max_bytes:
+                break
+            if self._remove_entry(key):
+                total -= index.pop(key)["size"]
+        if total > self.max_bytes:
+            logger.warning(
+                f"The cache exceeds {self.max_bytes} bytes because of pinned entries"
+                " or entries which are being downloaded."
+            )
+
+    def _remove_entry(self, key: str) -> bool:
+        """Remove the files of an entry unless it is being downloaded.
+
+        Doesn't wait for the lock of the entry because the lock of the index
+        is held, and a process holding the lock of the entry might wait for it.
+        """
+        with _try_file_lock(self.cache_dir / (key + ".lock")) as locked:
+            if locked:
+                _remove(self.cache_dir / key)
+        return locked
+
+    def evict(self):
+        """Evict entries until the cache fits into the byte budget."""
+        with self._index() as index:
+            # entries which were removed outside of the manager
+            for key in [key for key in index if not (self.cache_dir / key).exists()]:
+                del index[key]
+            self._evict(index)
+
+    def _set_pinned(self, filepath: Union[str, Path, UPath], pinned: bool):
+        _, path_str = infer_filesystem(filepath)
+        key = self._key(path_str)
+        with self._index() as index:
+            if key not in index:
+                raise KeyError(f"{path_str} is not in the cache.")
+            index[key]["pinned"] = pinned
+
+    def pin(self, filepath: Union[str, Path, UPath]):
+        """Exclude a cached object from eviction."""
+        self._set_pinned(filepath, True)
+
+    def unpin(self, filepath: Union[str, Path, UPath]):
+        """Allow eviction of a cached object."""
+        self._set_pinned(filepath, False)
+
+    def clear(self):
+        """Remove all unpinned entries which aren't being downloaded."""
+        with self._index() as index:
+            for key in [key for key in index if not index[key]["pinned"]]:
+                if self._remove_entry(key):
+                    del index[key]
+
+    @property
+    def size(self) -> int:
+        """The number of bytes in the cache."""
+        with self._index() as index:
+            return sum(entry["size"] for entry in index.values())
@@ -0,0 +1,330 @@
+import warnings
+from concurrent.futures import Executor
+from typing import Any, Dict, List, Optional
+
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+import zarr
+from anndata import AnnData, concat
+from anndata._io.specs import write_elem
+from anndata._io.specs.registry import get_spec
+from lamindb_setup.dev.upath import infer_filesystem
+from lnschema_core import File
+
+from ._parallel import map_ordered
+from .object._file_index import write_index
+from .object._read_coalesced import _read_elem_coalesced
+from .object._storage import _invalidate_storage, _open_storage
+from .object._subset_anndata import _select_adata_storage
+
+# the default size of the chunks of the concatenated arrays
+CHUNK_SIZE_BYTES = 2**22
+
+
+def _array_info(elem, n_axes: int = 1) -> Optional[tuple]:
+    """Sparsity, dtype and shape without the first `n_axes` of a stored array."""
+    if isinstance(elem, (zarr.Array, h5py.Dataset)):
+        if elem.dtype.kind not in "biufc":
+            return None
+        return False, elem.dtype, tuple(elem.shape[n_axes:])
+    if "h5sparse_format" in elem.attrs:
+        return None
+    if get_spec(elem).encoding_type in ("csr_matrix", "csc_matrix"):
+        return True, elem["data"].dtype, tuple(elem.attrs["shape"][n_axes:])
+    return None
+
+
+def _select_file(
+    file: File, query_obs, query_var, max_concurrency: Optional[int] = None
+) -> Optional[tuple]:
+    """Evaluate the queries and get the infos of the arrays to concatenate."""
+    with _open_storage(file, max_concurrency) as storage:
+        if storage is None:
+            return None
+        selection = _select_adata_storage(storage, query_obs, query_var)
+        if selection is None:
+            return None
+        # the var axis of X and layers is aligned separately
+        infos: Dict[str, Any] = dict(X=_array_info(storage["X"], 2))
+        for key in ("layers", "obsm"):
+            infos[key] = {}
+            if key not in storage:
+                continue
+            n_axes = 2 if key == "layers" else 1
+            for elem_key in storage[key].keys():
+                info = _array_info(storage[key][elem_key], n_axes)
+                if info is not None:
+                    infos[key][elem_key] = info
+    return selection, infos
+
+
+def _read_rows(
+    file: File,
+    obs_idx,
+    var_idx,
+    layers_keys: List[str],
+    obsm_keys: List[str],
+    max_concurrency: Optional[int] = None,
+) -> dict:
+    with _open_storage(file, max_concurrency) as storage:
+        # only files which were selected by _select_file are read
+        assert storage is not None
+        indices = (obs_idx, var_idx)
+        return dict(
+            X=_read_elem_coalesced(storage["X"], indices),
+            layers={
+                key: _read_elem_coalesced(storage["layers"][key], indices)
+                for key in layers_keys
+            },
+            obsm={
+                key: _read_elem_coalesced(storage["obsm"][key], (obs_idx, slice(None)))
+                for key in obsm_keys
+            },
+        )
+
+
+def _merge_infos(infos: List[Optional[tuple]], fill: bool) -> Optional[tuple]:
+    known = [info for info in infos if info is not None]
+    if len(known) < len(infos):
+        return None
+    if len({info[2] for info in known}) > 1:
+        return None
+    is_sparse = any(info[0] for info in known)
+    dtype = np.result_type(*(info[1] for info in known))
+    if fill and not is_sparse:
+        # missing values of dense arrays are filled with nan
+        dtype = np.result_type(dtype, np.float32)
+    return is_sparse, dtype, known[0][2]
+
+
+def _create_elem(group, key: str, info: tuple, shape: tuple, chunk_size_bytes: int):
+    is_sparse, dtype, _ = info
+    n_obs = shape[0]
+    if is_sparse:
+        elem = group.create_group(key)
+        elem.attrs.update(
+            {
+                "encoding-type": "csr_matrix",
+                "encoding-version": "0.1.0",
+                "shape": list(shape),
+            }
+        )
+        indices_dtype = np.int32 if shape[1] < np.iinfo(np.int32).max else np.int64
+        for name, arr_dtype, length in (
+            ("data", dtype, 0),
+            ("indices", indices_dtype, 0),
+            ("indptr", np.int64, n_obs + 1),
+        ):
+            itemsize = np.dtype(arr_dtype).itemsize
+            elem.create_dataset(
+                name,
+                shape=(length,),
+                chunks=(max(chunk_size_bytes // itemsize, 1),),
+                dtype=arr_dtype,
+                fill_value=0,
+            )
+    else:
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+        n_rows = max(min(n_obs, chunk_size_bytes // max(row_bytes, 1)), 1)
+        elem = group.create_dataset(
+            key, shape=shape, chunks=(n_rows, *shape[1:]), dtype=dtype
+        )
+        elem.attrs.update({"encoding-type": "array", "encoding-version": "0.2.0"})
+
+
+def _align_vars(block, columns: Optional[np.ndarray], n_vars: int, info: tuple):
+    """Move the columns of a block to `columns` of the concatenated array."""
+    is_sparse, dtype, _ = info
+    if sparse.issparse(block):
+        block = sparse.csr_matrix(block)
+        if columns is not None:
+            block = sparse.csr_matrix(
+                (block.data, columns[block.indices], block.indptr),
+                shape=(block.shape[0], n_vars),
+            )
+            block.sort_indices()
+        return block
+    block = np.asarray(block)
+    if columns is not None:
+        # like anndata.concat, missing values of sparse results are zeros
+        fill_value = np.nan if np.dtype(dtype).kind in "fc" and not is_sparse else 0
+        aligned = np.full((block.shape[0], n_vars), fill_value, dtype=dtype)
+        aligned[:, columns] = block
+        block = aligned
+    if is_sparse:
+        return sparse.csr_matrix(block)
+    return block
+
+
+def _write_rows(elem, block, start: int, info: tuple):
+    if info[0]:
+        indptr = elem["indptr"]
+        n_stored = indptr[start]
+        elem["data"].append(block.data.astype(elem["data"].dtype, copy=False))
+        elem["indices"].append(block.indices.astype(elem["indices"].dtype, copy=False))
+        indptr[start + 1 : start + 1 + block.shape[0]] = block.indptr[1:] + n_stored
+    else:
+        elem[start : start + block.shape[0]] = block
+
+
+def _var_columns(var_names: pd.Index, concat_var_names: pd.Index, var_idx):
+    """Get the stored columns to read and their positions in the result."""
+    positions = concat_var_names.get_indexer(var_names)
+    keep = positions >= 0
+    if not keep.all():
+        if isinstance(var_idx, slice):
+            var_idx = np.arange(len(var_names))
+        var_idx = list(np.asarray(var_idx)[keep])
+        positions = positions[keep]
+    if len(positions) == len(concat_var_names) and np.all(
+        positions == np.arange(len(positions))
+    ):
+        positions = None
+    return var_idx, positions
+
+
+def _concat_subsets_zarr(
+    files: List[File],
+    query_obs: list,
+    query_var: list,
+    storepath,
+    join: str = "inner",
+    batch_size: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    executor: Optional[Executor] = None,
+    max_concurrency: Optional[int] = None,
+    chunk_size_bytes: int = CHUNK_SIZE_BYTES,
+) -> Optional[int]:
+    """Concatenate subsets of AnnData files along `obs` into a zarr store.
+
+    Evaluates the queries first to get the shape of the result and
+    the inner or outer join of the selected `var_names` from the metadata.
+    Then preallocates the arrays of the zarr store and writes
+    the selected rows of each file into its slot, so only the selection
+    of one file or one batch of `batch_size` rows is held in memory at a time.
+
+    Keeps `.X` and the `.layers` and `.obsm` arrays present in all files.
+    `.var` has the columns of the first file which contains a variable,
+    missing values of dense arrays in an outer join are filled with `nan`.
+
+    Returns the total number of observations or `None` if nothing is selected.
+    """
+    if join not in ("inner", "outer"):
+        raise ValueError(f"join should be 'inner' or 'outer', not {join}.")
+
+    n_files = len(files)
+    selections = [
+        (file, result)
+        for file, result in zip(
+            files,
+            map_ordered(
+                _select_file,
+                files,
+                query_obs,
+                query_var,
+                [max_concurrency] * n_files,
+                max_workers=max_workers,
+                executor=executor,
+            ),
+        )
+        if result is not None
+    ]
+    if len(selections) == 0:
+        return None
+
+    var_list = [selection[1] for _, (selection, _) in selections]
+    # the same order of the variables as in anndata.concat
+    var_names = var_list[0].index
+    for var_file in var_list[1:]:
+        if join == "inner":
+            var_names = var_names.intersection(var_file.index)
+        else:
+            var_names = var_names.union(var_file.index)
+    var = pd.concat(var_list, join="outer")
+    var = var[~var.index.duplicated()].loc[var_names]
+    obs = concat(
+        [AnnData(obs=selection[0]) for _, (selection, _) in selections], join=join
+    ).obs
+    n_obs, n_vars = len(obs), len(var_names)
+    fill = join == "outer" and any(len(v.index) != n_vars for v in var_list)
+
+    infos = [file_infos for _, (_, file_infos) in selections]
+    x_info = _merge_infos([i["X"] for i in infos], fill)
+    if x_info is None:
+        raise ValueError("Can only concatenate numeric dense or sparse X.")
+    concat_infos: Dict[str, tuple] = dict(X=x_info)
+    for key in ("layers", "obsm"):
+        keys = [k for k in infos[0][key] if all(k in i[key] for i in infos)]
+        for elem_key in keys:
+            elem_infos = [i[key][elem_key] for i in infos]
+            info = _merge_infos(elem_infos, fill and key == "layers")
+            if info is not None:
+                concat_infos[f"{key}/{elem_key}"] = info
+    layers_keys = [k[7:] for k in concat_infos if k.startswith("layers/")]
+    obsm_keys = [k[5:] for k in concat_infos if k.startswith("obsm/")]
+
+    fs, storepath = infer_filesystem(storepath)
+    store = fs.get_mapper(storepath, create=True)
+    f = zarr.open(store, mode="w")
+    f.attrs.setdefault("encoding-type", "anndata")
+    f.attrs.setdefault("encoding-version", "0.1.0")
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning, module="zarr")
+        write_elem(f, "obs", obs)
+        write_elem(f, "var", var)
+        write_elem(f, "layers", {})
+        write_elem(f, "obsm", {})
+        for key, info in concat_infos.items():
+            if key.startswith("obsm/"):
+                shape = (n_obs, *info[2])
+            else:
+                shape = (n_obs, n_vars, *info[2])
+            _create_elem(f, key, info, shape, chunk_size_bytes)
+
+    # the slots of the files or batches in the result
+    reads = []
+    start = 0
+    for file, (selection, _) in selections:
+        file_obs, file_var, obs_idx, var_idx = selection
+        var_idx, columns = _var_columns(file_var.index, var_names, var_idx)
+        n_file_obs = len(file_obs)
+        step = n_file_obs if batch_size is None else batch_size
+        for batch_start in range(0, n_file_obs, step):
+            batch_stop = min(batch_start + step, n_file_obs)
+            if isinstance(obs_idx, slice):
+                batch_idx = slice(batch_start, batch_stop)
+            else:
+                batch_idx = obs_idx[batch_start:batch_stop]
+            reads.append((file, batch_idx, var_idx, start + batch_start, columns))
+        start += n_file_obs
+
+    blocks = map_ordered(
+        _read_rows,
+        [read[0] for read in reads],
+        [read[1] for read in reads],
+        [read[2] for read in reads],
+        [layers_keys] * len(reads),
+        [obsm_keys] * len(reads),
+        [max_concurrency] * len(reads),
+        max_workers=max_workers,
+        executor=executor,
+    )
+    for (_, _, _, slot, columns), block in zip(reads, blocks):
+        for key, info in concat_infos.items():
+            if key == "X":
+                elem = block["X"]
+            else:
+                group, elem_key = key.split("/", 1)
+                elem = block[group][elem_key]
+            if key.startswith("obsm/"):
+                elem = _align_vars(elem, None, n_vars, info)
+            else:
+                elem = _align_vars(elem, columns, n_vars, info)
+            _write_rows(f[key], elem, slot, info)
+
+    zarr.consolidate_metadata(store)
+    write_index(obs, var, storepath, fs)
+    _invalidate_storage(storepath, fs)
+    return n_obs
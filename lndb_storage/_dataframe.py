@@ -0,0 +1,223 @@
+import operator
+from typing import Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from lamindb_setup.dev.upath import infer_filesystem
+
+# filters are in disjunctive normal form like in pyarrow
+# [[(column, op, value), ...], ...] or [(column, op, value), ...]
+Filters = Union[List[tuple], List[List[tuple]]]
+
+FILTER_OPS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda column, value: column.isin(value),
+    "not in": lambda column, value: ~column.isin(value),
+}
+
+
+def _normalize_filters(filters: Optional[Filters]) -> List[List[tuple]]:
+    if not filters:
+        return []
+    if isinstance(filters[0], tuple):
+        filters = [filters]  # type: ignore
+    for conjunction in filters:
+        for _, op, _ in conjunction:  # type: ignore
+            if op not in FILTER_OPS:
+                raise ValueError(f"Unknown filter operator {op}.")
+    return [list(conjunction) for conjunction in filters]  # type: ignore
+
+
+def _filter_columns(filters: List[List[tuple]]) -> List[str]:
+    return list({column for conj in filters for column, _, _ in conj})
+
+
+def _filters_mask(df: pd.DataFrame, filters: List[List[tuple]]) -> np.ndarray:
+    mask = np.zeros(len(df), dtype=bool)
+    for conjunction in filters:
+        conj_mask = np.ones(len(df), dtype=bool)
+        for column, op, value in conjunction:
+            conj_mask &= np.asarray(FILTER_OPS[op](df[column], value), dtype=bool)
+        mask |= conj_mask
+    return mask
+
+
+def _apply_filters(df: pd.DataFrame, filters, columns: Optional[List[str]]):
+    if filters:
+        df = df[_filters_mask(df, filters)]
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def _stats_may_match(stats: dict, conjunction: List[tuple]) -> bool:
+    """Check if a row group with the column statistics `stats` can match."""
+    for column, op, value in conjunction:
+        if column not in stats:
+            continue
+        vmin, vmax = stats[column]
+        try:
+            if op in ("=", "==") and (value < vmin or value > vmax):
+                return False
+            elif op == "<" and vmin >= value:
+                return False
+            elif op == "<=" and vmin > value:
+                return False
+            elif op == ">" and vmax <= value:
+                return False
+            elif op == ">=" and vmax < value:
+                return False
+            elif op == "in" and all(v < vmin or v > vmax for v in value):
+                return False
+        except TypeError:  # incomparable types, can't prune
+            continue
+    return True
+
+
+def _row_group_stats(metadata, i: int) -> dict:
+    row_group = metadata.row_group(i)
+    stats = {}
+    for j in range(row_group.num_columns):
+        column = row_group.column(j)
+        statistics = column.statistics
+        if statistics is not None and statistics.has_min_max:
+            stats[column.path_in_schema] = (statistics.min, statistics.max)
+    return stats
+
+
+def _range_index_metadata(schema) -> Optional[dict]:
+    """Get the pandas metadata of a stored `RangeIndex`, if there is one."""
+    pandas_metadata = schema.pandas_metadata
+    if pandas_metadata is None:
+        return None
+    index_columns = pandas_metadata.get("index_columns", [])
+    if len(index_columns) == 1 and isinstance(index_columns[0], dict):
+        if index_columns[0].get("kind") == "range":
+            return index_columns[0]
+    return None
+
+
+def _slice_range_index(range_index: dict, offset: int, n_rows: int) -> pd.RangeIndex:
+    """The part of a stored `RangeIndex` for `n_rows` rows starting at `offset`."""
+    start, step = range_index["start"], range_index["step"]
+    return pd.RangeIndex(
+        start + step * offset,
+        start + step * (offset + n_rows),
+        step,
+        name=range_index["name"],
+    )
+
+
+def iter_parquet(
+    filepath,
+    columns: Optional[List[str]] = None,
+    filters: Optional[Filters] = None,
+    chunksize: Optional[int] = None,
+) -> Iterator[pd.DataFrame]:
+    """Stream a parquet file in chunks directly from its filesystem.
+
+    Only reads the requested columns and skips row groups
+    which can't match the filters based on their statistics.
+    """
+    import pyarrow.parquet as pq
+
+    fs, filepath = infer_filesystem(filepath)
+    filters = _normalize_filters(filters)
+    read_columns = None
+    if columns is not None:
+        read_columns = columns + [
+            column for column in _filter_columns(filters) if column not in columns
+        ]
+
+    with fs.open(filepath, mode="rb") as f:
+        parquet_file = pq.ParquetFile(f)
+        metadata = parquet_file.metadata
+        row_groups = list(range(metadata.num_row_groups))
+        if filters:
+            row_groups = [
+                i
+                for i in row_groups
+                if any(
+                    _stats_may_match(_row_group_stats(metadata, i), conj)
+                    for conj in filters
+                )
+            ]
+        if len(row_groups) == 0:
+            empty = parquet_file.schema_arrow.empty_table().to_pandas()
+            yield _apply_filters(empty, [], columns)
+            return None
+        range_index = _range_index_metadata(parquet_file.schema_arrow)
+        # the position of the first row of every row group
+        n_groups = metadata.num_row_groups
+        n_rows = [metadata.row_group(i).num_rows for i in range(n_groups)]
+        offsets = np.cumsum([0] + n_rows)
+        for i in row_groups:
+            # read every row group separately to know the positions of the rows
+            offset = int(offsets[i])
+            batches = parquet_file.iter_batches(
+                batch_size=chunksize if chunksize is not None else 65536,
+                row_groups=[i],
+                columns=read_columns,
+                use_pandas_metadata=True,
+            )
+            for batch in batches:
+                df = batch.to_pandas()
+                if range_index is not None:
+                    df.index = _slice_range_index(range_index, offset, len(df))
+                offset += len(df)
+                yield _apply_filters(df, filters, columns)
+
+
+def iter_csv(
+    filepath,
+    columns: Optional[List[str]] = None,
+    filters: Optional[Filters] = None,
+    chunksize: int = 65536,
+) -> Iterator[pd.DataFrame]:
+    """Stream a csv file in chunks directly from its filesystem."""
+    fs, filepath = infer_filesystem(filepath)
+    filters = _normalize_filters(filters)
+    usecols = None
+    if columns is not None:
+        usecols = columns + [
+            column for column in _filter_columns(filters) if column not in columns
+        ]
+
+    with fs.open(filepath, mode="rb") as f:
+        for df in pd.read_csv(f, usecols=usecols, chunksize=chunksize):
+            yield _apply_filters(df, filters, columns)
+
+
+def read_dataframe(
+    filepath,
+    columns: Optional[List[str]] = None,
+    filters: Optional[Filters] = None,
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """Read a csv or parquet file with column selection and filters.
+
+    Returns an iterator over chunks of `chunksize` rows if `chunksize` is passed.
+    """
+    suffix = str(filepath).rsplit(".", 1)[-1]
+    if suffix == "parquet":
+        chunks = iter_parquet(filepath, columns, filters, chunksize)
+    elif suffix == "csv":
+        if chunksize is not None:
+            chunks = iter_csv(filepath, columns, filters, chunksize)
+        else:
+            chunks = iter_csv(filepath, columns, filters)
+    else:
+        raise ValueError(f"Can only read .csv and .parquet files, not .{suffix}.")
+
+    if chunksize is not None:
+        return chunks
+    dfs = list(chunks)
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs)
@@ -1,7 +1,9 @@
 import os
 import shutil
 from pathlib import Path
-from typing import Union
+from threading import Lock
+from typing import List, Optional, Union
+from uuid import uuid4
 
 import fsspec
 import pandas as pd
@@ -9,8 +11,13 @@ import readfcs
 from lamindb_setup import settings
 from lamindb_setup.dev.upath import UPath
 
+from ._cache import CacheManager, _same_checksum
+from ._dataframe import Filters, read_dataframe
 from ._h5ad import read_adata_h5ad
+from ._parallel import map_ordered
 from ._zarr import read_adata_zarr
+from .object._file_index import _copy_index, _index_path
+from .object._storage import _invalidate_storage
 
 READER_FUNCS = {
     ".csv": pd.read_csv,
@@ -40,9 +47,248 @@ class ProgressCallback(fsspec.callbacks.Callback):
         return None
 
 
-def store_object(localpath: Union[str, Path], storagekey: str) -> float:
+class _AggregateProgress:
+    """Byte-level upload progress aggregated over many files."""
+
+    def __init__(self, size: int, filepath: Union[str, Path]):
+        self.size = size
+        self.value = 0
+        self.filepath = filepath
+        self._printed = -1.0
+        self._lock = Lock()
+
+    def update(self, inc: int):
+        with self._lock:
+            self.value += inc
+            # print only if the displayed progress changes
+            progress = round(self.value / max(self.size, 1), 2)
+            if progress != self._printed:
+                self._printed = progress
+                print_hook(max(self.size, 1), self.value, filepath=self.filepath)
+
+
+class _FileProgressCallback(fsspec.callbacks.Callback):
+    def __init__(self, progress: _AggregateProgress):
+        super().__init__()
+        self._progress = progress
+        self._reported = 0
+
+    def call(self, *args, **kwargs):
+        inc = self.value - self._reported
+        if inc > 0:
+            self._reported = self.value
+            self._progress.update(inc)
+
+
+def _list_files(path: Path) -> List[Path]:
+    """List the files of a directory tree, following symlinked directories."""
+    return [
+        Path(root) / filename
+        for root, _, filenames in os.walk(path, followlinks=True)
+        for filename in filenames
+    ]
+
+
+def _is_uploaded(localpath: Path, info: Optional[dict]) -> bool:
+    """Check whether the remote object has the same size and hash."""
+    if info is None or info.get("size") != localpath.stat().st_size:
+        return False
+    return _same_checksum(localpath, info) is True
+
+
+def _upload(
+    localpath: Path,
+    storagepath: UPath,
+    max_workers: int = 8,
+    multipart_chunksize: Optional[int] = None,
+    show_progress: bool = True,
+):
+    """Upload a file or a directory with concurrent transfers.
+
+    Skips files which are already present with the same size and hash.
+    """
+    fs = storagepath.fs
+    storagepath_str = str(storagepath)
+
+    if localpath.is_file():
+        uploads = [(localpath, storagepath_str)]
+        try:
+            remote_infos = {storagepath_str: fs.info(storagepath_str)}
+        except FileNotFoundError:
+            remote_infos = {}
+    else:
+        uploads = [
+            (file, f"{storagepath_str}/{file.relative_to(localpath).as_posix()}")
+            for file in _list_files(localpath)
+        ]
+        # a single listing instead of checking every file
+        try:
+            found = fs.find(storagepath_str, detail=True)
+        except FileNotFoundError:
+            found = {}
+        remote_infos = {
+            path: found.get(fs._strip_protocol(path)) for _, path in uploads
+        }
+
+    size = sum(file.stat().st_size for file, _ in uploads)
+    progress = _AggregateProgress(size, localpath) if show_progress else None
+    put_kwargs = {}
+    if multipart_chunksize is not None:
+        put_kwargs["chunksize"] = multipart_chunksize
+
+    def upload_file(file: Path, path: str):
+        if _is_uploaded(file, remote_infos.get(path)):
+            if progress is not None:
+                progress.update(file.stat().st_size)
+            return None
+        if progress is not None:
+            callback = _FileProgressCallback(progress)
+        else:
+            callback = fsspec.callbacks.NoOpCallback()
+        fs.put_file(str(file), path, callback=callback, **put_kwargs)
+
+    for _ in map_ordered(
+        upload_file,
+        [file for file, _ in uploads],
+        [path for _, path in uploads],
+        max_workers=max_workers,
+    ):
+        pass
+
+
+# the ioctl request to clone a file on linux, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # not available on windows
+        return False
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            return False
+
+
+def _clone_file(src: str, dst: str, link: Optional[str] = None):
+    """Copy a file, or hardlink or reflink it if possible."""
+    if link == "hardlink":
+        try:
+            os.link(src, dst)
+            return None
+        except OSError:
+            pass
+    elif link == "reflink" and _reflink(src, dst):
+        return None
+    shutil.copy2(src, dst)
+
+
+def _copytree(
+    src: Union[str, Path],
+    dst: Union[str, Path],
+    max_workers: int = 8,
+    link: Optional[str] = None,
+):
+    """Copy a directory tree with concurrent file copies.
+
+    Like `shutil.copytree`, copies the contents of symlinked files and directories.
+    """
+    srcs, dsts = [], []
+    for root, dirnames, filenames in os.walk(src, followlinks=True):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        for filename in filenames:
+            srcs.append(os.path.join(root, filename))
+            dsts.append(os.path.join(dst_root, filename))
+    for _ in map_ordered(
+        _clone_file, srcs, dsts, [link] * len(srcs), max_workers=max_workers
+    ):
+        pass
+
+
+def _rmtree(path: Union[str, Path], max_workers: int = 8):
+    """Delete a directory tree with concurrent file deletions."""
+    files, dirs = [], []
+    for root, dirnames, filenames in os.walk(path, topdown=False):
+        files += [os.path.join(root, filename) for filename in filenames]
+        for dirname in dirnames:
+            dirpath = os.path.join(root, dirname)
+            # os.walk doesn't descend into symlinked directories
+            if os.path.islink(dirpath):
+                files.append(dirpath)
+        dirs.append(root)
+    for _ in map_ordered(os.unlink, files, max_workers=max_workers):
+        pass
+    # children come before their parents with topdown=False
+    for dirpath in dirs:
+        os.rmdir(dirpath)
+
+
+def _copy_local(
+    localpath: Path, storagepath: Path, max_workers: int = 8, link: Optional[str] = None
+):
+    """Copy a file or directory into place, replacing an existing one.
+
+    The copy is first written to a temporary path next to `storagepath`
+    and then renamed, so readers never see a partially written copy.
+    """
+    if storagepath.exists() and os.path.samefile(localpath, storagepath):
+        return None
+    storagepath.parent.mkdir(parents=True, exist_ok=True)
+    uid = uuid4().hex
+    tmppath = storagepath.parent / f".{storagepath.name}.tmp-{uid}"
+
+    if localpath.is_file():
+        try:
+            _clone_file(str(localpath), str(tmppath), link)
+            os.replace(tmppath, storagepath)
+        finally:
+            if tmppath.exists():
+                tmppath.unlink()
+        return None
+
+    try:
+        _copytree(localpath, tmppath, max_workers, link)
+    except Exception as e:
+        _rmtree(tmppath, max_workers)
+        raise e
+    if storagepath.exists():
+        oldpath = storagepath.parent / f".{storagepath.name}.old-{uid}"
+        os.rename(storagepath, oldpath)
+        os.rename(tmppath, storagepath)
+        _rmtree(oldpath, max_workers)
+    else:
+        os.rename(tmppath, storagepath)
+
+
+def store_object(
+    localpath: Union[str, Path],
+    storagekey: str,
+    max_workers: int = 8,
+    multipart_chunksize: Optional[int] = None,
+    link: Optional[str] = None,
+) -> float:
     """Store arbitrary file to configured storage location.
 
+    For cloud storage, uploads the files of a directory concurrently
+    and skips files which are already present with the same size and hash.
+
+    For local storage, copies the files of a directory concurrently
+    into a temporary directory and then renames it to the storage path.
+
+    Args:
+        localpath: The local file or directory.
+        storagekey: The storage key.
+        max_workers: The number of concurrent uploads or copies.
+        multipart_chunksize: The part size for multipart uploads
+        of large files in bytes, uses the filesystem default if `None`.
+        link: For local storage, `"hardlink"` or `"reflink"` to link
+        the files instead of copying them if the filesystem allows it.
+        Note that changes to hardlinked local files also change the stored files.
+
     Returns size in bytes.
     """
     storagepath = settings.instance.storage.key_to_filepath(storagekey)
@@ -51,60 +297,96 @@ def store_object(localpath: Union[str, Path], storagekey: str) -> float:
     if localpath.is_file():
         size = localpath.stat().st_size
     else:
-        size = sum(f.stat().st_size for f in localpath.rglob("*") if f.is_file())
+        size = sum(f.stat().st_size for f in _list_files(localpath))
 
     if isinstance(storagepath, UPath):
-        if localpath.suffix != ".zarr":
-            cb = ProgressCallback()
-        else:
-            # todo: make proper progress bar for zarr
-            cb = fsspec.callbacks.NoOpCallback()
-        storagepath.upload_from(localpath, recursive=True, callback=cb)
+        _upload(localpath, storagepath, max_workers, multipart_chunksize)
     else:  # storage path is local
-        storagepath.parent.mkdir(parents=True, exist_ok=True)
-        if localpath.is_file():
-            try:
-                shutil.copyfile(localpath, storagepath)
-            except shutil.SameFileError:
-                pass
-        else:
-            if storagepath.exists():
-                shutil.rmtree(storagepath)
-            shutil.copytree(localpath, storagepath)
+        _copy_local(localpath, storagepath, max_workers, link)
+    if localpath.suffix in (".h5ad", ".zarr", ".zrad"):
+        # the sidecar index of an AnnData file, see write_index
+        # a stale index of an overwritten file is removed
+        _copy_index(localpath, storagepath)
+        _invalidate_storage(storagepath)
     return float(size)  # because this is how we store in the db
 
 
-def delete_storage(storagekey: str):
-    """Delete arbitrary file."""
+def delete_storage(storagekey: str, max_workers: int = 8):
+    """Delete arbitrary file and its sidecar index."""
     storagepath = settings.instance.storage.key_to_filepath(storagekey)
+    index_storagepath = _index_path(storagepath)
+    if index_storagepath.is_file():
+        index_storagepath.unlink()
     if storagepath.is_file():
         storagepath.unlink()
     elif storagepath.is_dir():
         if isinstance(storagepath, UPath):
             storagepath.rmdir()
         else:
-            shutil.rmtree(storagepath)
+            _rmtree(storagepath, max_workers)
     else:
         raise FileNotFoundError(f"{storagepath} is not an existing path!")
+    _invalidate_storage(storagepath)
 
 
-def load_to_memory(filepath: Union[str, Path, UPath], stream: bool = False):
+def load_to_memory(
+    filepath: Union[str, Path, UPath],
+    stream: bool = False,
+    backed: bool = False,
+    columns: Optional[List[str]] = None,
+    filters: Optional[Filters] = None,
+    chunksize: Optional[int] = None,
+    cache_manager: Optional[CacheManager] = None,
+):
     """Load a file into memory.
 
     Returns the filepath if no in-memory form is found.
+
+    For `.csv` and `.parquet` files, `columns`, `filters` and `chunksize`
+    are pushed down to the reader and the file is streamed
+    from the storage instead of being cached locally in full.
+
+    Args:
+        filepath: The path of the file.
+        stream: Stream `.h5ad` files instead of caching them locally.
+        backed: Return an `AnnDataAccessor` for `.h5ad` and `.zarr` files
+            which reads the metadata and only loads the accessed slices.
+            Implies `stream`.
+        columns: Only load these columns.
+        filters: Only load rows which match these filters, in the disjunctive
+            normal form of pyarrow, e.g. `[("n_genes", ">", 100)]`.
+            Row groups of parquet files are skipped based on their statistics.
+        chunksize: Return an iterator over chunks of `chunksize` rows.
+        cache_manager: Download the file through this cache manager
+            instead of caching it in the instance cache without eviction.
     """
     if isinstance(filepath, str):
         filepath = Path(filepath)
 
+    pushdown = columns is not None or filters is not None or chunksize is not None
+    if pushdown:
+        if filepath.suffix not in {".csv", ".parquet"}:
+            raise ValueError(
+                "columns, filters and chunksize are only supported for .csv and"
+                " .parquet files."
+            )
+        return read_dataframe(filepath, columns, filters, chunksize)
+
+    if filepath.suffix in {".h5ad", ".zarr"} and backed:
+        return READER_FUNCS[filepath.suffix](filepath, backed=True)
+
     if filepath.suffix == ".zarr":
         stream = True
     elif filepath.suffix != ".h5ad":
         stream = False
 
     if not stream:
-        # caching happens here if filename is a UPath
-        # todo: make it safe when filepath is just Path
-        filepath = settings.instance.storage.cloud_to_local(filepath)
+        if cache_manager is not None:
+            filepath = cache_manager.get(filepath)
+        else:
+            # caching happens here if filename is a UPath
+            # todo: make it safe when filepath is just Path
+            filepath = settings.instance.storage.cloud_to_local(filepath)
 
     reader = READER_FUNCS.get(filepath.suffix)
     if reader is None:
@@ -1,15 +1,29 @@
+from typing import Union
+
 import anndata
 from anndata import AnnData
 from lamindb_setup import settings
 from lamindb_setup.dev.upath import infer_filesystem
 
+from .object._anndata_accessor import AnnDataAccessor
+
 
 def h5ad_to_anndata(filekey) -> AnnData:
     """h5ad → AnnData."""
     return anndata.read(settings.instance.storage.local_filepath(filekey))
 
 
-def read_adata_h5ad(filepath, **kwargs) -> AnnData:
+def read_adata_h5ad(
+    filepath, backed: bool = False, **kwargs
+) -> Union[AnnData, AnnDataAccessor]:
+    """Read an h5ad file.
+
+    If `backed` is `True`, returns an `AnnDataAccessor`
+    which only reads the metadata and loads the accessed slices on demand.
+    """
+    if backed:
+        return AnnDataAccessor(filepath, **kwargs)
+
     fs, filepath = infer_filesystem(filepath)
 
     with fs.open(filepath, mode="rb") as file:
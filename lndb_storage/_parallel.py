@@ -0,0 +1,55 @@
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+
+def map_ordered(
+    func: Callable,
+    *iterables,
+    max_workers: Optional[int] = None,
+    executor: Optional[Executor] = None,
+    max_in_flight: Optional[int] = None,
+) -> Iterator:
+    """Apply `func` concurrently and yield the results in input order.
+
+    Results are yielded as soon as they and all preceding results are ready.
+    At most `max_in_flight` calls are submitted ahead of the result
+    that is yielded next, this bounds the number of results held in memory
+    while waiting for a slow call.
+
+    Args:
+        func: The function to apply, needs to be picklable for process pools.
+        *iterables: Iterables of arguments as in `map`.
+        max_workers: The number of threads to use if `executor` is not passed.
+        executor: An existing thread or process pool executor.
+        max_in_flight: The maximum number of pending calls,
+        defaults to twice the number of workers.
+    """
+    if executor is None and (max_workers is None or max_workers <= 1):
+        yield from map(func, *iterables)
+        return
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    if max_in_flight is None:
+        if max_workers:
+            n_workers = max_workers
+        else:
+            n_workers = getattr(executor, "_max_workers", 1)
+        max_in_flight = 2 * n_workers
+    max_in_flight = max(max_in_flight, 1)
+
+    futures: deque = deque()
+    try:
+        for args in zip(*iterables):
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+            futures.append(executor.submit(func, *args))  # type: ignore
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)  # type: ignore
@@ -1,23 +1,162 @@
-from typing import List, Optional, Union
+from concurrent.futures import Executor
+from pathlib import PurePosixPath
+from typing import Iterator, List, Optional, Tuple, Union
 
 from anndata import AnnData, concat
 from lamin_logger import logger
 from lnschema_core import File
 
-from .object import LazySelector, _subset_anndata_file
+from ._concat import _concat_subsets_zarr
+from ._parallel import map_ordered
+from .object import (
+    LazySelector,
+    _file_may_match,
+    _subset_anndata_file,
+    _subset_anndata_file_batches,
+    compile_selector,
+)
+from .object._anndata_accessor import AnnDataAccessor
 
 SUFFIXES = (".h5ad", ".zarr")
 
 
+def _compile_queries(queries: list) -> list:
+    """Compile every distinct lazy selector once for all files."""
+    compiled: dict = {}
+    for query in queries:
+        if id(query) not in compiled:
+            compiled[id(query)] = compile_selector(query)
+    return [compiled[id(query)] for query in queries]
+
+
+def _select_files(
+    files: Union[List[File], File],
+    query_obs,
+    query_var,
+    max_workers: Optional[int] = None,
+    executor: Optional[Executor] = None,
+    use_index: bool = True,
+) -> Tuple[List[File], list, list]:
+    """Get the AnnData files to subset and their compiled queries."""
+    if isinstance(files, File):
+        files = [files]
+
+    n_files = len(files)
+    if isinstance(query_obs, list):
+        if len(query_obs) != n_files:
+            raise ValueError("query_obs list should be the same length as files.")
+    else:
+        query_obs = [query_obs] * n_files
+    if isinstance(query_var, list):
+        if len(query_var) != n_files:
+            raise ValueError("query_var list should be the same length as files.")
+    else:
+        query_var = [query_var] * n_files
+    query_obs = _compile_queries(query_obs)
+    query_var = _compile_queries(query_var)
+
+    selected = []
+    for i, file in enumerate(files):
+        if file.suffix not in SUFFIXES:
+            logger.warning(f"File {file.id} is not an AnnData object, ignoring.")
+            continue
+        selected.append(i)
+
+    if use_index:
+        may_match = map_ordered(
+            _file_may_match,
+            [files[i] for i in selected],
+            [query_obs[i] for i in selected],
+            [query_var[i] for i in selected],
+            max_workers=max_workers,
+            executor=executor,
+        )
+        selected = [i for i, match in zip(selected, list(may_match)) if match]
+
+    return (
+        [files[i] for i in selected],
+        [query_obs[i] for i in selected],
+        [query_var[i] for i in selected],
+    )
+
+
+def subset_iter(
+    files: Union[List[File], File],
+    query_obs: Optional[Union[List[str], str, LazySelector]] = None,
+    query_var: Optional[Union[List[str], str, LazySelector]] = None,
+    batch_size: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    executor: Optional[Executor] = None,
+    max_concurrency: Optional[int] = None,
+    use_index: bool = True,
+) -> Iterator[AnnData]:
+    """Subset AnnData files and lazily yield the results.
+
+    Only the results which are yielded but not yet consumed are held in memory.
+
+    Args:
+        files: A `File` or a list of `Files` containing `AnnData` objects
+        to subset.
+        query_obs: The pandas query string to evaluate on `.obs` of each
+        underlying `AnnData` object.
+        query_var: The pandas query string to evaluate on `.var` of each
+        underlying `AnnData` object.
+        batch_size: If passed, yields the selected observations
+        of each file in batches of at most `batch_size` rows,
+        otherwise yields one `AnnData` object per file.
+        max_workers: The number of threads to subset the files concurrently.
+        Ignored if `batch_size` is passed.
+        executor: An existing thread or process pool executor to use
+        instead of creating a thread pool with `max_workers` threads.
+        Ignored if `batch_size` is passed.
+        max_concurrency: The maximum number of concurrent requests
+        to fetch the chunks of a zarr file.
+        use_index: Skip the files which can't match the queries
+        according to their sidecar indices without opening them.
+    """
+    files, query_obs, query_var = _select_files(
+        files, query_obs, query_var, max_workers, executor, use_index
+    )
+
+    if batch_size is not None:
+        for file, q_obs, q_var in zip(files, query_obs, query_var):
+            yield from _subset_anndata_file_batches(
+                file, q_obs, q_var, batch_size, max_concurrency
+            )
+        return
+
+    results = map_ordered(
+        _subset_anndata_file,
+        files,
+        query_obs,
+        query_var,
+        [max_concurrency] * len(files),
+        max_workers=max_workers,
+        executor=executor,
+    )
+    for result in results:
+        if result is not None:
+            yield result
+
+
 def subset(
     files: Union[List[File], File],
     query_obs: Optional[Union[List[str], str, LazySelector]] = None,
     query_var: Optional[Union[List[str], str, LazySelector]] = None,
     use_concat: bool = False,
     concat_args: Optional[dict] = None,
-) -> Union[List[AnnData], AnnData, None]:
+    max_workers: Optional[int] = None,
+    executor: Optional[Executor] = None,
+    max_concurrency: Optional[int] = None,
+    use_index: bool = True,
+    storepath=None,
+    batch_size: Optional[int] = None,
+) -> Union[List[AnnData], AnnData, AnnDataAccessor, None]:
     """Subset AnnData files and stream results into memory.
 
+    See :func:`~lndb_storage.subset_iter` to avoid holding
+    all results in memory at once.
+
     Args:
         files: A `File` or a list of `Files` containing `AnnData` objects
         to subset and load into memory.
@@ -28,31 +167,65 @@ def subset(
         use_concat: If `True`, applies `anndata.concat` on
         the returned `AnnData` objects.
         concat_args: Arguments for concatenation.
+        max_workers: The number of threads to subset the files concurrently.
+        The results are returned in the order of `files`.
+        executor: An existing thread or process pool executor to use
+        instead of creating a thread pool with `max_workers` threads.
+        max_concurrency: The maximum number of concurrent requests
+        to fetch the chunks of a zarr file.
+        use_index: Skip the files which can't match the queries
+        according to their sidecar indices without opening them.
+        storepath: If passed with `use_concat`, concatenates out of core
+        into a zarr store at this path and returns an `AnnDataAccessor` for it.
+        The arrays are preallocated from the metadata and the selected rows
+        of each file are written into their slots as they arrive.
+        Keeps `.X` and the `.layers` and `.obsm` arrays present in all files.
+        Only `"join"` of `concat_args` is supported then.
+        batch_size: Writes the selections in batches of at most `batch_size` rows
+        if `storepath` is passed.
     """
-    if isinstance(files, File):
-        files = [files]
+    if storepath is not None:
+        if not use_concat:
+            raise ValueError("storepath can only be passed with use_concat=True.")
+        # checked before anything is written, see AnnDataAccessor
+        suffix = PurePosixPath(str(storepath).rstrip("/")).suffix
+        if suffix not in (".zarr", ".zrad"):
+            raise ValueError(f"storepath should have .zarr suffix, not {suffix}.")
+        unsupported = set(concat_args or {}) - {"join"}
+        if unsupported:
+            raise ValueError(
+                "Only join of concat_args is supported with storepath,"
+                f" not {sorted(unsupported)}."
+            )
+        files, query_obs, query_var = _select_files(
+            files, query_obs, query_var, max_workers, executor, use_index
+        )
+        n_obs = _concat_subsets_zarr(
+            files,
+            query_obs,
+            query_var,
+            storepath,
+            join=(concat_args or {}).get("join", "inner"),
+            batch_size=batch_size,
+            max_workers=max_workers,
+            executor=executor,
+            max_concurrency=max_concurrency,
+        )
+        if n_obs is None:
+            return None
+        return AnnDataAccessor(storepath)
 
-    n_files = len(files)
-    if isinstance(query_obs, list):
-        if len(query_obs) != n_files:
-            raise ValueError("query_obs list should be the same length as files.")
-    else:
-        query_obs = [query_obs] * n_files  # type: ignore
-    if isinstance(query_var, list):
-        if len(query_var) != n_files:
-            raise ValueError("query_var list should be the same length as files.")
-    else:
-        query_var = [query_var] * n_files  # type: ignore
-
-    adatas = []
-    # todo: implement parallel processing
-    for i, file in enumerate(files):
-        if file.suffix not in SUFFIXES:
-            logger.warning(f"File {file.id} is not an AnnData object, ignoring.")
-            continue
-        result = _subset_anndata_file(file, query_obs[i], query_var[i])
-        if result is not None:
-            adatas.append(result)
+    adatas = list(
+        subset_iter(
+            files,
+            query_obs,
+            query_var,
+            max_workers=max_workers,
+            executor=executor,
+            max_concurrency=max_concurrency,
+            use_index=use_index,
+        )
+    )
 
     if not use_concat:
         return adatas
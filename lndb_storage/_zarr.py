@@ -1,28 +1,105 @@
 import warnings
-from typing import Optional
+from functools import partial
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Union
 
+import numpy as np
 import scipy.sparse as sparse
 import zarr
-from anndata import AnnData
+from anndata import AnnData, concat
 from anndata._io import read_zarr
 from anndata._io.specs import write_elem
+from anndata._io.specs.registry import get_spec, read_elem
+from anndata.compat import _read_attr
 from lamindb_setup.dev.upath import infer_filesystem
 
-from .object._anndata_sizes import _size_elem, _size_raw, size_adata
+from ._parallel import map_ordered
+from .object._anndata_accessor import AnnDataAccessor
+from .object._anndata_sizes import _size_elem, _size_raw, _size_val, size_adata
+from .object._file_index import _remove_index, write_index
+from .object._storage import _invalidate_storage, _open_zarr
 
 
-def read_adata_zarr(storepath) -> AnnData:
+def read_adata_zarr(
+    storepath, backed: bool = False, **kwargs
+) -> Union[AnnData, AnnDataAccessor]:
+    """Read an AnnData object from a zarr store.
+
+    If `backed` is `True`, returns an `AnnDataAccessor`
+    which only reads the metadata and loads the accessed slices on demand.
+    """
+    if backed:
+        return AnnDataAccessor(storepath, **kwargs)
+
     fs, storepath = infer_filesystem(storepath)
 
+    storage = _open_zarr(fs, storepath)
+    if _read_attr(storage.attrs, "encoding-type", None) == "anndata":
+        return read_elem(storage)
+    # older stores need the backwards compatibility of read_zarr
     store = fs.get_mapper(storepath, check=True)
     adata = read_zarr(store)
 
     return adata
 
 
+def _auto_chunks(elem, chunk_size_bytes: int) -> Optional[tuple]:
+    """Chunks of about `chunk_size_bytes` bytes for dense and sparse arrays.
+
+    Dense arrays are chunked along the first axis only,
+    the arrays of sparse matrices into equal 1d chunks.
+    """
+    if isinstance(elem, np.ndarray):
+        if elem.ndim == 0 or elem.dtype.kind not in "biufc":
+            return None
+        row_bytes = elem.dtype.itemsize * int(np.prod(elem.shape[1:]))
+        n_rows = min(elem.shape[0], chunk_size_bytes // max(row_bytes, 1))
+        return (max(n_rows, 1), *elem.shape[1:])
+    if sparse.issparse(elem):
+        itemsize = max(elem.data.dtype.itemsize, elem.indices.dtype.itemsize)
+        return (max(min(elem.nnz, chunk_size_bytes // itemsize), 1),)
+    return None
+
+
 def write_adata_zarr(
-    adata: AnnData, storepath, callback=None, chunks=None, **dataset_kwargs
+    adata: AnnData,
+    storepath,
+    callback=None,
+    chunks=None,
+    consolidate_metadata: bool = True,
+    build_index: bool = True,
+    max_workers: int = 1,
+    element_kwargs: Optional[Dict[str, dict]] = None,
+    chunk_size_bytes: Optional[int] = None,
+    **dataset_kwargs,
 ):
+    """Write an AnnData object to a zarr store.
+
+    If `consolidate_metadata` is `True`, writes the metadata of all groups
+    and arrays into the `.zmetadata` key to open the store with one request.
+
+    If `build_index` is `True`, writes a sidecar index of `.obs` and `.var`
+    next to the store which allows :func:`~lndb_storage.subset`
+    to skip the store if it can't match a query.
+
+    Args:
+        adata: The AnnData object.
+        storepath: The path of the zarr store.
+        callback: Called with the total size and the size written so far.
+        chunks: The chunks of a dense `.X`.
+        consolidate_metadata: Consolidate the metadata of the store.
+        build_index: Write the sidecar index.
+        max_workers: The number of threads to write the elements
+            and the arrays of `.obsm`, `.layers` etc concurrently.
+            The chunks of an array are written concurrently
+            by async filesystems like s3 anyway.
+        element_kwargs: Dataset kwargs for specific elements like `"X"`,
+            `"layers"` or `"obs"` which update `dataset_kwargs`, e.g.
+            `{"X": dict(compressor=numcodecs.Blosc("zstd", shuffle=2))}`.
+        chunk_size_bytes: Chunk dense and sparse arrays without explicit `chunks`
+            into chunks of about this number of bytes.
+        dataset_kwargs: Passed to the creation of all arrays.
+    """
     fs, storepath = infer_filesystem(storepath)
 
     store = fs.get_mapper(storepath, create=True)
@@ -37,51 +114,198 @@ def write_adata_zarr(
 
     adata_size = None
     cumulative_val = 0
+    cb_lock = Lock()
 
-    def _cb(key_write: Optional[str] = None):
+    def _cb(elem_size: Optional[int] = None):
         nonlocal adata_size
         nonlocal cumulative_val
 
         if callback is None:
             return None
-        if adata_size is None:
-            adata_size = size_adata(adata)
-        if key_write is None:
-            # begin or finish
-            if cumulative_val < adata_size:
-                callback(adata_size, adata_size if cumulative_val > 0 else 0)
-            return None
+        with cb_lock:
+            if adata_size is None:
+                adata_size = size_adata(adata)
+            if elem_size is None:
+                # begin or finish
+                if cumulative_val < adata_size:
+                    callback(adata_size, adata_size if cumulative_val > 0 else 0)
+                return None
+            if elem_size == 0:
+                return None
 
-        elem = getattr(adata, key_write, None)
-        if elem is None:
-            return None
-        elem_size = _size_raw(elem) if key_write == "raw" else _size_elem(elem)
-        if elem_size == 0:
-            return None
+            cumulative_val += elem_size
+            callback(adata_size, cumulative_val)
+
+    def _elem_kwargs(key: str, elem) -> dict:
+        kwargs = {**dataset_kwargs, **(element_kwargs or {}).get(key, {})}
+        if key == "X" and chunks is not None and not sparse.issparse(elem):
+            kwargs.setdefault("chunks", chunks)
+        if chunk_size_bytes is not None and "chunks" not in kwargs:
+            elem_chunks = _auto_chunks(elem, chunk_size_bytes)
+            if elem_chunks is not None:
+                kwargs["chunks"] = elem_chunks
+        return kwargs
 
-        cumulative_val += elem_size
-        callback(adata_size, cumulative_val)
+    # (group, key, element, dataset kwargs, size for the callback)
+    writes: List[tuple] = []
 
-    def _write_elem_cb(f, k, elem, dataset_kwargs):
-        write_elem(f, k, elem, dataset_kwargs=dataset_kwargs)
-        _cb(k)
+    def _write_elem_cb(group, key, elem, dataset_kwargs, size):
+        write_elem(group, key, elem, dataset_kwargs=dataset_kwargs)
+        if callback is not None:
+            _cb(size())
 
     _cb(None)
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=UserWarning, module="zarr")
 
-        if chunks is not None and not isinstance(adata.X, sparse.spmatrix):
-            _write_elem_cb(
-                f, "X", adata.X, dataset_kwargs=dict(chunks=chunks, **dataset_kwargs)
+        for key in ("X", "obs", "var"):
+            elem = getattr(adata, key)
+            writes.append(
+                (f, key, elem, _elem_kwargs(key, elem), partial(_size_elem, elem))
             )
-        else:
-            _write_elem_cb(f, "X", adata.X, dataset_kwargs=dataset_kwargs)
-        for elem in ("obs", "var"):
-            _write_elem_cb(f, elem, getattr(adata, elem), dataset_kwargs=dataset_kwargs)
-        for elem in ("obsm", "varm", "obsp", "varp", "layers", "uns"):
-            _write_elem_cb(
-                f, elem, dict(getattr(adata, elem)), dataset_kwargs=dataset_kwargs
+        for key in ("obsm", "varm", "obsp", "varp", "layers", "uns"):
+            # write the group first to write its elements separately
+            write_elem(f, key, {})
+            group = f[key]
+            for elem_key, elem in getattr(adata, key).items():
+                writes.append(
+                    (
+                        group,
+                        elem_key,
+                        elem,
+                        _elem_kwargs(key, elem),
+                        partial(_size_val, elem),
+                    )
+                )
+        if adata.raw is not None:
+            writes.append(
+                (
+                    f,
+                    "raw",
+                    adata.raw,
+                    {**dataset_kwargs, **(element_kwargs or {}).get("raw", {})},
+                    partial(_size_raw, adata.raw),
+                )
             )
-        _write_elem_cb(f, "raw", adata.raw, dataset_kwargs=dataset_kwargs)
-    # todo: fix size less than total at the end
+
+        for _ in map_ordered(_write_elem_cb, *zip(*writes), max_workers=max_workers):
+            pass
+    if consolidate_metadata:
+        zarr.consolidate_metadata(store)
+    if build_index:
+        write_index(adata.obs, adata.var, storepath, fs)
+    else:
+        _remove_index(storepath, fs)
+    _invalidate_storage(storepath, fs)
     _cb(None)
+
+
+def _append_elem_zarr(group: zarr.Group, key: str, elem):
+    stored = group[key]
+    if isinstance(stored, zarr.Array):
+        stored.append(np.asarray(elem), axis=0)
+        return None
+
+    if get_spec(stored).encoding_type != "csr_matrix":
+        raise ValueError(f"Can only append dense or csr arrays, not {key}.")
+    elem = sparse.csr_matrix(elem)
+    indptr_offset = stored["indptr"][-1]
+    stored["data"].append(elem.data)
+    stored["indices"].append(elem.indices)
+    stored["indptr"].append(elem.indptr[1:] + indptr_offset)
+    n_rows, n_cols = stored.attrs["shape"]
+    stored.attrs["shape"] = [n_rows + elem.shape[0], n_cols]
+
+
+def write_adatas_zarr(
+    adatas: Iterable[AnnData],
+    storepath,
+    chunks=None,
+    consolidate_metadata: bool = True,
+    build_index: bool = True,
+    **dataset_kwargs,
+) -> Optional[int]:
+    """Concatenate AnnData objects along `obs` and write incrementally to zarr.
+
+    Only one object of `adatas` is processed at a time, so this can consume
+    a generator like :func:`~lndb_storage.subset_iter` without holding
+    all the data in memory. Only the `.obs` dataframes are kept until the end.
+
+    All objects should have the same `var_names`. Like `anndata.concat`,
+    keeps only the `.layers` and `.obsm` keys present in all objects
+    and drops `.obsp`, `.varm`, `.varp`, `.uns` and `.raw`
+    if more than one object is written.
+
+    If `consolidate_metadata` is `True`, consolidates the metadata
+    after all objects are written. If `build_index` is `True`,
+    writes the sidecar index of the concatenated object.
+
+    Returns the total number of observations or `None` if `adatas` is empty.
+    """
+    fs, storepath = infer_filesystem(storepath)
+
+    f = None
+    var_names = None
+    obs_list = []
+    layers_keys: set = set()
+    obsm_keys: set = set()
+
+    for adata in adatas:
+        if f is None:
+            write_adata_zarr(
+                adata,
+                storepath,
+                chunks=chunks,
+                consolidate_metadata=False,
+                build_index=False,
+                **dataset_kwargs,
+            )
+            store = fs.get_mapper(storepath)
+            f = zarr.open(store, mode="r+")
+            var = adata.var
+            var_names = adata.var_names
+            layers_keys = set(adata.layers.keys())
+            obsm_keys = set(adata.obsm.keys())
+        else:
+            if not adata.var_names.equals(var_names):
+                raise ValueError("All AnnData objects should have the same var_names.")
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", category=UserWarning, module="zarr")
+                _append_elem_zarr(f, "X", adata.X)
+                layers_keys &= set(adata.layers.keys())
+                for key in layers_keys:
+                    _append_elem_zarr(f["layers"], key, adata.layers[key])
+                obsm_keys &= set(adata.obsm.keys())
+                for key in obsm_keys:
+                    _append_elem_zarr(f["obsm"], key, adata.obsm[key])
+        obs_list.append(adata.obs)
+
+    if f is None:
+        return None
+
+    obs = obs_list[0]
+    if len(obs_list) > 1:
+        for elem, keys in (("layers", layers_keys), ("obsm", obsm_keys)):
+            if elem not in f:
+                continue
+            for key in list(f[elem].keys()):
+                if key not in keys:
+                    del f[elem][key]
+        for elem in ("obsp", "varm", "varp", "uns", "raw"):
+            if elem in f:
+                del f[elem]
+        # concat to get the same obs as anndata.concat would produce
+        obs = concat([AnnData(obs=obs) for obs in obs_list]).obs
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=UserWarning, module="zarr")
+            write_elem(f, "obs", obs, dataset_kwargs=dataset_kwargs)
+
+    if consolidate_metadata:
+        zarr.consolidate_metadata(store)
+    if build_index:
+        write_index(obs, var, storepath, fs)
+    else:
+        _remove_index(storepath, fs)
+    _invalidate_storage(storepath, fs)
+
+    return sum(len(obs) for obs in obs_list)
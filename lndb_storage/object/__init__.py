@@ -10,6 +10,9 @@ Memory → file:
 
 from ._anndata import anndata_to_h5ad
 from ._anndata_sizes import size_adata
+from ._collection_accessor import AnnDataCollectionAccessor
 from ._core import infer_suffix, write_to_file
-from ._lazy_field import LazySelector, lazy
-from ._subset_anndata import _subset_anndata_file
+from ._file_index import _file_may_match
+from ._lazy_field import LazySelector, compile_selector, lazy
+from ._loader import AnnDataLoader
+from ._subset_anndata import _subset_anndata_file, _subset_anndata_file_batches
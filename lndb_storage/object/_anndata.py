@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 from anndata import AnnData
@@ -6,22 +7,61 @@ from lamin_logger import logger
 from lamindb_setup import settings
 from typeguard import typechecked
 
+from ._file_index import _copy_index, _remove_index, write_index
+from ._storage import _invalidate_storage
+
+
+def _write_index(adata: AnnData, path, build_index: bool):
+    if build_index:
+        write_index(adata.obs, adata.var, path)
+    else:
+        _remove_index(path)
+
+
+def _write_upload(adata: AnnData, path, local_file: Path, build_index: bool = True):
+    logger.debug(f"Writing cache file: {local_file}.")
+    adata.write(local_file)
+    _write_index(adata, local_file, build_index)
+    logger.debug("Uploading cache file.")
+    path.upload_from(local_file)  # type: ignore
+    _copy_index(local_file, path)
+    _invalidate_storage(path)
+
 
 @typechecked
-def anndata_to_h5ad(adata: AnnData, filekey: str) -> Path:
-    """AnnData → h5ad."""
+def anndata_to_h5ad(
+    adata: AnnData,
+    filekey: str,
+    keep_local_cache: bool = True,
+    build_index: bool = True,
+) -> Path:
+    """AnnData → h5ad.
+
+    For cloud storage, the h5ad file is written locally and then uploaded
+    because HDF5 needs random access to the whole file while writing.
+    If `keep_local_cache` is `False`, the local file is written
+    to a temporary directory, removed after the upload
+    and the cloud path is returned.
+
+    If `build_index` is `True`, writes a sidecar index of `.obs` and `.var`
+    next to the file which allows :func:`~lndb_storage.subset`
+    to skip the file if it can't match a query.
+    """
     path = settings.instance.storage.key_to_filepath(filekey)
-    if settings.instance.storage.is_cloud:
+    if settings.instance.storage.is_cloud and not keep_local_cache:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            _write_upload(adata, path, Path(tmp_dir) / path.name, build_index)
+        return path
+    elif settings.instance.storage.is_cloud:
         cache_file = settings.instance.storage.cloud_to_local_no_update(path)  # type: ignore  # noqa
         cache_file.parent.mkdir(exist_ok=True)
-        logger.debug(f"Writing cache file: {cache_file}.")
-        adata.write(cache_file)
-        logger.debug("Uploading cache file.")
-        path.upload_from(cache_file)  # type: ignore
+        _write_upload(adata, path, cache_file, build_index)
         # to avoid download from the cloud within synchronization
         mtime = path.modified.timestamp()
         os.utime(cache_file, times=(mtime, mtime))
     else:
         adata.write(path)
+        _write_index(adata, path, build_index)
+        _invalidate_storage(path)
         cache_file = path
     return cache_file
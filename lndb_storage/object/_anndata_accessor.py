@@ -1,20 +1,30 @@
-from functools import cached_property
-from typing import Dict, Mapping, Union
+from pathlib import Path, PurePosixPath
+from typing import Dict, Mapping, Optional, Union
 
 import h5py
 import pandas as pd
 import zarr
-from anndata._core.index import Index, _normalize_indices
+from anndata._core.index import Index
 from anndata._core.sparse_dataset import SparseDataset
-from anndata._core.views import _resolve_idx
 from anndata._io.specs.methods import read_indices
-from anndata._io.specs.registry import get_spec, read_elem, read_elem_partial
+from anndata._io.specs.registry import get_spec, read_elem
 from anndata.compat import _read_attr
+from lamindb_setup.dev.upath import UPath
 from lamindb_setup.dev.upath import infer_filesystem as _infer_filesystem
 from lnschema_core import File
 from lnschema_core._core import filepath_from_file_or_folder
 
-from ._subset_anndata import _read_dataframe
+from ._attrs_cache import ATTRS_CACHE, CacheStats, _cached_attr
+from ._lazy_dataframe import _lazy_dataframe, _LazyDataFrame
+from ._metadata_cache import _cached_metadata
+from ._read_coalesced import _read_elem_coalesced
+from ._selection import (
+    _as_index,
+    _compose_indices,
+    _selection_len,
+    _selection_names,
+)
+from ._storage import STORAGE_POOL, _Handle
 
 
 def _try_backed_full(elem):
@@ -42,7 +52,7 @@ class _MapAccessor:
         if self.indices is None:
             return _try_backed_full(self.elem[key])
         else:
-            return read_elem_partial(self.elem[key], indices=self.indices)
+            return _read_elem_coalesced(self.elem[key], indices=self.indices)
 
     def keys(self):
         return list(self.elem.keys())
@@ -58,43 +68,44 @@ class _AnnDataAttrsMixin:
     storage: Union[h5py.File, zarr.Group]
     _attrs_keys: Mapping[str, list]
 
-    @cached_property
-    def obs(self) -> pd.DataFrame:
+    @_cached_attr
+    def obs(self) -> Union[pd.DataFrame, _LazyDataFrame]:
+        """The observations, read column by column.
+
+        Unlike `AnnData.obs`, this is a lazy dataframe and not a `pd.DataFrame`,
+        call `.to_pandas()` to get one. Dataframes written in the legacy format
+        are read fully into a `pd.DataFrame`.
+        """
         if "obs" not in self._attrs_keys:
             return None
         indices = getattr(self, "indices", None)
-        if indices is not None:
-            indices = (indices[0], slice(None))
-            return read_elem_partial(self.storage["obs"], indices=indices)
-        else:
-            return _read_dataframe(self.storage["obs"])
+        rows = indices[0] if indices is not None else None
+        return _lazy_dataframe(self.storage["obs"], rows)
 
-    @cached_property
-    def var(self) -> pd.DataFrame:
+    @_cached_attr
+    def var(self) -> Union[pd.DataFrame, _LazyDataFrame]:
+        """The variables, read column by column like `obs`."""
         if "var" not in self._attrs_keys:
             return None
         indices = getattr(self, "indices", None)
-        if indices is not None:
-            indices = (indices[1], slice(None))
-            return read_elem_partial(self.storage["var"], indices=indices)
-        else:
-            return _read_dataframe(self.storage["var"])
+        rows = indices[1] if indices is not None else None
+        return _lazy_dataframe(self.storage["var"], rows)
 
-    @cached_property
+    @_cached_attr
     def uns(self):
         if "uns" not in self._attrs_keys:
             return None
         return read_elem(self.storage["uns"])
 
-    @cached_property
+    @_cached_attr
     def X(self):
         indices = getattr(self, "indices", None)
         if indices is not None:
-            return read_elem_partial(self.storage["X"], indices=indices)
+            return _read_elem_coalesced(self.storage["X"], indices=indices)
         else:
             return _try_backed_full(self.storage["X"])
 
-    @cached_property
+    @_cached_attr
     def obsm(self):
         if "obsm" not in self._attrs_keys:
             return None
@@ -103,7 +114,7 @@ class _AnnDataAttrsMixin:
             indices = (indices[0], slice(None))
         return _MapAccessor(self.storage["obsm"], "obsm", indices)
 
-    @cached_property
+    @_cached_attr
     def varm(self):
         if "varm" not in self._attrs_keys:
             return None
@@ -112,7 +123,7 @@ class _AnnDataAttrsMixin:
             indices = (indices[1], slice(None))
         return _MapAccessor(self.storage["varm"], "varm", indices)
 
-    @cached_property
+    @_cached_attr
     def obsp(self):
         if "obsp" not in self._attrs_keys:
             return None
@@ -121,7 +132,7 @@ class _AnnDataAttrsMixin:
             indices = (indices[0], indices[0])
         return _MapAccessor(self.storage["obsp"], "obsp", indices)
 
-    @cached_property
+    @_cached_attr
     def varp(self):
         if "varp" not in self._attrs_keys:
             return None
@@ -130,13 +141,18 @@ class _AnnDataAttrsMixin:
             indices = (indices[1], indices[1])
         return _MapAccessor(self.storage["varp"], "varp", indices)
 
-    @cached_property
+    @_cached_attr
     def layers(self):
         if "layers" not in self._attrs_keys:
             return None
         indices = getattr(self, "indices", None)
         return _MapAccessor(self.storage["layers"], "layers", indices)
 
+    @property
+    def cache_stats(self) -> CacheStats:
+        """Statistics of the attributes cache shared by all accessors."""
+        return ATTRS_CACHE.stats
+
     @property
     def obs_names(self):
         return self._obs_names
@@ -145,37 +161,92 @@ class _AnnDataAttrsMixin:
     def var_names(self):
         return self._var_names
 
-    @cached_property
+    @_cached_attr
     def shape(self):
         return len(self._obs_names), len(self._var_names)
 
 
 class AnnDataAccessorSubset(_AnnDataAttrsMixin):
-    def __init__(self, storage, indices, attrs_keys, obs_names, var_names, ref_shape):
+    """Subset of an AnnData object in the storage.
+
+    `indices` are slices or int64 positions in the reference object
+    with the names `obs_names` and `var_names`, the names of the subset
+    are only selected when they are accessed.
+    A subset holds the pooled storage handle of its accessor,
+    so the storage stays open as long as the subset is used.
+    """
+
+    def __init__(
+        self,
+        storage,
+        indices,
+        attrs_keys,
+        obs_names,
+        var_names,
+        ref_shape,
+        handle: Optional[_Handle] = None,
+    ):
         self.storage = storage
         self.indices = indices
+        if handle is not None:
+            STORAGE_POOL.retain(handle)
+        self._handle = handle
 
         self._attrs_keys = attrs_keys
-        self._obs_names, self._var_names = obs_names, var_names
+        # the names of the reference object, shared by all its subsets
+        self._obs_ref, self._var_ref = _as_index(obs_names), _as_index(var_names)
+        self._obs_names: Optional[pd.Index] = None
+        self._var_names: Optional[pd.Index] = None
 
         self._ref_shape = ref_shape
 
+    @property
+    def _selection(self) -> tuple:
+        if self.indices is None:
+            return slice(None), slice(None)
+        return self.indices
+
+    @property
+    def obs_names(self) -> pd.Index:
+        if self._obs_names is None:
+            self._obs_names = _selection_names(self._selection[0], self._obs_ref)
+        return self._obs_names
+
+    @property
+    def var_names(self) -> pd.Index:
+        if self._var_names is None:
+            self._var_names = _selection_names(self._selection[1], self._var_ref)
+        return self._var_names
+
+    @property
+    def shape(self) -> tuple:
+        oidx, vidx = self._selection
+        n_obs = _selection_len(oidx, len(self._obs_ref))
+        return n_obs, _selection_len(vidx, len(self._var_ref))
+
     def __getitem__(self, index: Index):
         """Access a subset of the underlying AnnData object."""
-        oidx, vidx = _normalize_indices(index, self._obs_names, self._var_names)
-        new_obs_names, new_var_names = self._obs_names[oidx], self._var_names[vidx]
-        if self.indices is not None:
-            oidx = _resolve_idx(self.indices[0], oidx, self._ref_shape[0])
-            vidx = _resolve_idx(self.indices[1], vidx, self._ref_shape[1])
+        indices = _compose_indices(self._selection, index, self._obs_ref, self._var_ref)
         return type(self)(
             self.storage,
-            (oidx, vidx),
+            indices,
             self._attrs_keys,
-            new_obs_names,
-            new_var_names,
+            self._obs_ref,
+            self._var_ref,
             self._ref_shape,
+            self._handle,
         )
 
+    def close(self):
+        """Release the storage handle to the pool."""
+        handle = self.__dict__.pop("_handle", None)
+        if handle is not None:
+            STORAGE_POOL.release(handle)
+
+    def __del__(self):
+        """Releases the storage handle."""
+        self.close()
+
     def __repr__(self):
         """Description of the object."""
         n_obs, n_vars = self.shape
@@ -184,28 +255,35 @@ class AnnDataAccessorSubset(_AnnDataAttrsMixin):
             descr += f"\n  {attr}: {keys}"
         return descr
 
-    @cached_property
+    @_cached_attr
     def raw(self):
         if "raw" not in self._attrs_keys:
             return None
         prepare_indices = None
-        if self.indices is not None:
-            oidx = self.indices[0]
-            if oidx != slice(None):
-                prepare_indices = oidx, slice(None)
+        oidx = self._selection[0]
+        if not (isinstance(oidx, slice) and oidx == slice(None)):
+            prepare_indices = oidx, slice(None)
         return AnnDataRawAccessor(
             self.storage["raw"],
             prepare_indices,
             None,
-            self._obs_names,
+            self._obs_ref,
             None,
             self._ref_shape[0],
+            self._handle,
         )
 
 
 class AnnDataRawAccessor(AnnDataAccessorSubset):
     def __init__(
-        self, storage_raw, indices, attrs_keys, obs_names, var_names, ref_shape
+        self,
+        storage_raw,
+        indices,
+        attrs_keys,
+        obs_names,
+        var_names,
+        ref_shape,
+        handle: Optional[_Handle] = None,
     ):
         var_raw = storage_raw["var"]
 
@@ -231,7 +309,7 @@ class AnnDataRawAccessor(AnnDataAccessorSubset):
                     attrs_keys["varm"] = varm_keys_raw
 
         super().__init__(
-            storage_raw, indices, attrs_keys, obs_names, var_names, ref_shape
+            storage_raw, indices, attrs_keys, obs_names, var_names, ref_shape, handle
         )
 
     @property
@@ -240,48 +318,88 @@ class AnnDataRawAccessor(AnnDataAccessorSubset):
 
 
 class AnnDataAccessor(_AnnDataAttrsMixin):
-    def __init__(self, file: File):
-        fs, file_path_str = _infer_filesystem(filepath_from_file_or_folder(file))
-
-        if file.suffix == ".h5ad":
-            self._conn = fs.open(file_path_str, mode="rb")
-            try:
-                self.storage = h5py.File(self._conn, mode="r")
-            except Exception as e:
-                self._conn.close()
-                raise e
-            self._attrs_keys = _keys_h5(self.storage)
-        elif file.suffix in (".zarr", ".zrad"):
-            self._conn = None
-            mapper = fs.get_mapper(file_path_str, check=True)
-            self.storage = zarr.open(mapper, mode="r")
-            self._attrs_keys = _keys_zarr(self.storage)
+    def __init__(
+        self,
+        file: Union[File, str, Path, UPath],
+        max_concurrency: Optional[int] = None,
+        h5ad_cache_options: Optional[dict] = None,
+        use_metadata_cache: bool = True,
+    ):
+        if isinstance(file, File):
+            file_path = filepath_from_file_or_folder(file)
+            suffix, name = file.suffix, file.name
+        else:
+            file_path = file
+            # PurePosixPath to also get the name of cloud paths passed as strings
+            path = PurePosixPath(str(file).rstrip("/"))
+            suffix, name = path.suffix, path.name
+        fs, file_path_str = _infer_filesystem(file_path)
+
+        if suffix == ".h5ad":
+            keys_func = _keys_h5
+        elif suffix in (".zarr", ".zrad"):
+            keys_func = _keys_zarr
         else:
             raise ValueError(
-                f"file should have .h5ad, .zarr or .zrad suffix, not {file.suffix}."
+                f"file should have .h5ad, .zarr or .zrad suffix, not {suffix}."
             )
+        # open files are shared with other accessors of the same file
+        self._handle = STORAGE_POOL.acquire(
+            fs, file_path_str, suffix, max_concurrency, h5ad_cache_options
+        )
+        self.storage = self._handle.storage
+        self.io_stats = self._handle.io_stats
 
-        self._name = file.name
+        self._name = name
 
-        self._obs_names, self._var_names = read_indices(self.storage)
+        def read_metadata():
+            obs_names, var_names = read_indices(self.storage)
+            return dict(
+                attrs_keys=keys_func(self.storage),
+                obs_names=obs_names,
+                var_names=var_names,
+            )
+
+        if use_metadata_cache:
+            metadata = _cached_metadata(fs, file_path_str, suffix, read_metadata)
+        else:
+            metadata = read_metadata()
+        self._attrs_keys = metadata["attrs_keys"]
+        # the hash tables of the indices are shared by all subsets
+        self._obs_names = _as_index(metadata["obs_names"])
+        self._var_names = _as_index(metadata["var_names"])
+
+    def close(self):
+        """Release the storage handle to the pool."""
+        handle = self.__dict__.pop("_handle", None)
+        if handle is not None:
+            STORAGE_POOL.release(handle)
+
+    def __enter__(self):
+        """Use the accessor as a context manager which releases the handle."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Release the storage handle."""
+        self.close()
 
     def __del__(self):
-        """Closes the connection."""
-        if self._conn is not None:
-            self.storage.close()
-            self._conn.close()
+        """Releases the storage handle."""
+        self.close()
 
     def __getitem__(self, index: Index) -> AnnDataAccessorSubset:
         """Access a subset of the underlying AnnData object."""
-        oidx, vidx = _normalize_indices(index, self._obs_names, self._var_names)
-        new_obs_names, new_var_names = self._obs_names[oidx], self._var_names[vidx]
+        indices = _compose_indices(
+            (slice(None), slice(None)), index, self._obs_names, self._var_names
+        )
         return AnnDataAccessorSubset(
             self.storage,
-            (oidx, vidx),
+            indices,
             self._attrs_keys,
-            new_obs_names,
-            new_var_names,
+            self._obs_names,
+            self._var_names,
             self.shape,
+            self.__dict__.get("_handle"),
         )
 
     def __repr__(self):
@@ -293,16 +411,23 @@ class AnnDataAccessor(_AnnDataAttrsMixin):
             descr += f"\n    {attr}: {keys}"
         return descr
 
-    @cached_property
+    @_cached_attr
     def raw(self):
         if "raw" not in self._attrs_keys:
             return None
         return AnnDataRawAccessor(
-            self.storage["raw"], None, None, self._obs_names, None, self.shape[0]
+            self.storage["raw"],
+            None,
+            None,
+            self._obs_names,
+            None,
+            self.shape[0],
+            self.__dict__.get("_handle"),
         )
 
 
 # this is needed because accessing zarr.Group.keys() directly is very slow
+# with consolidated metadata, only the metadata keys are listed here
 def _keys_zarr(storage: zarr.Group):
     paths = storage._store.keys()
 
@@ -1,31 +1,170 @@
+from typing import Union
+
+import numpy as np
 import scipy.sparse as sparse
-from pandas import DataFrame
+from pandas import CategoricalDtype, DataFrame, Index, Series
+
+# the number of bytes sampled to estimate the compression ratio of an array
+COMPRESSION_SAMPLE_BYTES = 2**20
+
+
+def _size_array(arr: np.ndarray, compressor=None) -> int:
+    """The number of bytes of an array, estimated after compression if passed.
+
+    Compresses up to `COMPRESSION_SAMPLE_BYTES` in three blocks of rows
+    from the beginning, the middle and the end of the array.
+    """
+    if arr.dtype.kind == "O":
+        # the payloads of python objects like strings
+        return arr.nbytes + sum(
+            len(v.encode()) if isinstance(v, str) else _size_val(v) for v in arr.flat
+        )
+    if compressor is None or arr.ndim == 0 or arr.nbytes == 0:
+        return arr.nbytes
+
+    n_rows = arr.shape[0]
+    row_bytes = max(arr.nbytes // n_rows, 1)
+    n_sample_rows = min(max(COMPRESSION_SAMPLE_BYTES // (3 * row_bytes), 1), n_rows)
+    starts = np.unique(np.linspace(0, n_rows - n_sample_rows, 3).astype(int))
+    sample_bytes = compressed_bytes = 0
+    for start in starts:
+        block = np.ascontiguousarray(arr[start : start + n_sample_rows])
+        sample_bytes += block.nbytes
+        compressed_bytes += len(compressor.encode(block))
+    return int(arr.nbytes * compressed_bytes / sample_bytes)
+
+
+def _size_objects(values: Union[Index, Series], compressor=None) -> int:
+    """The size of strings and other objects in an index or a series.
+
+    The estimate after compression uses the lengths of the encoded strings
+    instead of the memory of the python objects. Only up to
+    `COMPRESSION_SAMPLE_BYTES` of values from the beginning, the middle
+    and the end are encoded.
+    """
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind != "O":
+        return _size_array(values.to_numpy(), compressor)
+    if compressor is None:
+        if isinstance(values, Series):
+            return values.memory_usage(index=False, deep=True)
+        return values.memory_usage(deep=True)
+    n_values = len(values)
+    array = values.array
+    block_bytes = max(COMPRESSION_SAMPLE_BYTES // 3, 1)
+    bounds = np.unique(np.linspace(0, n_values, 4).astype(int))
+    encoded = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        n_bytes = 0
+        for value in array[start:stop]:
+            encoded.append(str(value).encode())
+            n_bytes += len(encoded[-1])
+            if n_bytes >= block_bytes:
+                break
+    sample = b"".join(encoded)
+    if len(sample) == 0:
+        return 0
+    size = len(sample) * n_values / len(encoded)
+    return int(size * len(compressor.encode(sample)) / len(sample))
+
+
+def _size_series(series: Series, compressor=None) -> int:
+    dtype = series.dtype
+    if isinstance(dtype, CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        categories = dtype.categories
+        return _size_array(codes, compressor) + _size_objects(categories, compressor)
+    return _size_objects(series, compressor)
 
 
-def _size_val(val):
-    if sparse.issparse(val):
-        val_csr = sparse.csr_matrix(val)
-        return val_csr.data.nbytes + val_csr.indptr.nbytes + val_csr.indices.nbytes
+def _size_dataframe(df: DataFrame, compressor=None) -> int:
+    size = _size_objects(df.index, compressor)
+    for column in df.columns:
+        size += _size_series(df[column], compressor)
+    return size
+
+
+def _size_sparse(val, compressor=None) -> int:
+    if hasattr(val, "indptr"):  # csr, csc, bsr
+        arrays = (val.data, val.indices, val.indptr)
+    elif hasattr(val, "row"):  # coo
+        arrays = (val.data, val.row, val.col)
     else:
-        return val.__sizeof__()
+        # the size of the csr representation without conversion
+        return val.nnz * (val.dtype.itemsize + 4) + (val.shape[0] + 1) * 4
+    return sum(_size_array(arr, compressor) for arr in arrays)
 
 
-def _size_elem(elem):
-    if hasattr(elem, "keys") and not isinstance(elem, DataFrame):
-        return sum([_size_val(elem[k]) for k in elem.keys()])
+def _size_val(val, compressor=None) -> int:
+    """The number of bytes of a value without copying it.
+
+    Estimates the compressed size if `compressor` is passed,
+    only numeric arrays are compressed for the estimate.
+    """
+    if val is None:
+        return 0
+    elif sparse.issparse(val):
+        return _size_sparse(val, compressor)
+    elif isinstance(val, np.ndarray):
+        return _size_array(val, compressor)
+    elif isinstance(val, DataFrame):
+        return _size_dataframe(val, compressor)
+    elif isinstance(val, Series):
+        return _size_series(val, compressor)
+    elif isinstance(val, Index):
+        return _size_objects(val, compressor)
+    elif isinstance(val, str):
+        return len(val.encode())
+    elif isinstance(val, bytes):
+        return len(val)
+    elif isinstance(val, (bool, int, float, complex, np.generic)):
+        return np.asarray(val).nbytes
+    elif hasattr(val, "keys"):
+        return sum(_size_val(val[k], compressor) for k in val.keys())
+    elif isinstance(val, (list, tuple)):
+        return sum(_size_val(v, compressor) for v in val)
     else:
-        return _size_val(elem)
+        return val.__sizeof__()
+
+
+def _size_elem(elem, compressor=None) -> int:
+    return _size_val(elem, compressor)
+
+
+def _size_raw(raw, compressor=None) -> int:
+    sizes = [
+        _size_val(raw.X, compressor),
+        _size_val(raw.var, compressor),
+        _size_elem(raw.varm, compressor),
+    ]
+    return sum(sizes)
+
+
+def size_adata(adata, compressed: bool = False, compressor=None) -> int:
+    """The number of bytes of the elements of an AnnData object.
 
+    Sums the sizes of the same elements which are written
+    by :func:`~lndb_storage.write_adata_zarr`.
 
-def _size_raw(raw):
-    return _size_val(raw.X) + _size_val(raw.var) + _size_elem(raw.varm)
+    Args:
+        adata: The AnnData object.
+        compressed: Estimate the size on disk after compression
+            by compressing samples of the numeric arrays.
+        compressor: The compressor for the estimate,
+            defaults to the default compressor of zarr.
+    """
+    if compressed and compressor is None:
+        from zarr.storage import default_compressor
 
+        compressor = default_compressor
+    elif not compressed:
+        compressor = None
 
-def size_adata(adata):
-    total_size = adata.__sizeof__()
+    total_size = 0
+    for key in ("X", "obs", "var", "obsm", "varm", "obsp", "varp", "layers", "uns"):
+        total_size += _size_elem(getattr(adata, key), compressor)
 
     raw = adata.raw
     if raw is not None:
-        total_size += _size_raw(raw)
+        total_size += _size_raw(raw, compressor)
 
     return total_size
@@ -0,0 +1,171 @@
+import itertools
+import weakref
+from collections import OrderedDict
+from functools import partial
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Optional, Set
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+from ._anndata_sizes import _size_val
+from ._lazy_dataframe import _LazyDataFrame
+
+# the default byte budget of the cache of accessor attributes
+MAX_ATTRS_CACHE_BYTES = 2**30
+
+
+class CacheStats:
+    """Hits, misses and evictions of a cache and the number of cached bytes."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.n_bytes = 0
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        """Description of the CacheStats object."""
+        return (
+            f"CacheStats(hits={self.hits}, misses={self.misses},"
+            f" evictions={self.evictions}, n_bytes={self.n_bytes})"
+        )
+
+
+def _in_memory_size(value) -> int:
+    """The number of bytes of in-memory data, backed objects are free.
+
+    Lazy dataframes count their loaded columns.
+    """
+    if isinstance(value, _LazyDataFrame):
+        return value._cache_bytes
+    if isinstance(value, (np.ndarray, pd.DataFrame, pd.Series, pd.Index, dict)):
+        return _size_val(value)
+    if sparse.issparse(value):
+        return _size_val(value)
+    return 0
+
+
+class _AttrsCache:
+    """Least recently used cache of attributes shared by accessors.
+
+    Entries are keyed by the token of an accessor and the attribute name,
+    the entries of an accessor are dropped when it is garbage collected.
+    Values larger than `max_bytes` are not cached.
+    Lazy dataframes report the size of the columns they load.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes if max_bytes is not None else MAX_ATTRS_CACHE_BYTES
+        self.stats = CacheStats()
+        self._entries: OrderedDict = OrderedDict()
+        # the cached names of every token
+        self._names: Dict[int, Set[Hashable]] = {}
+        self._lock = Lock()
+        self._tokens = itertools.count()
+
+    def token(self, obj) -> int:
+        """Get the token of an object, register the cleanup on the first call."""
+        token = obj.__dict__.get("_attrs_cache_token")
+        if token is None:
+            with self._lock:
+                token = obj.__dict__.get("_attrs_cache_token")
+                if token is None:
+                    token = next(self._tokens)
+                    obj.__dict__["_attrs_cache_token"] = token
+                    weakref.finalize(obj, self.discard, token)
+        return token
+
+    def get(self, token: int, name: Hashable, compute: Callable[[], Any]):
+        key = (token, name)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return self._entries[key][0]
+            self.stats.misses += 1
+
+        value = compute()
+        size = _in_memory_size(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key in self._entries:
+                # computed concurrently by another thread
+                return self._entries[key][0]
+            self._entries[key] = (value, size)
+            self._names.setdefault(token, set()).add(name)
+            self.stats.n_bytes += size
+            if isinstance(value, _LazyDataFrame):
+                value._size_listener = partial(self._resize, key)
+            self._evict()
+        return value
+
+    def _resize(self, key: tuple, value, size: int):
+        """Update the size of a cached value which loaded more data."""
+        with self._lock:
+            entry = self._entries.get(key)
+            # the value could have been evicted or replaced
+            if entry is None or entry[0] is not value:
+                return None
+            self._entries[key] = (value, size)
+            self.stats.n_bytes += size - entry[1]
+            self._evict()
+
+    def _evict(self):
+        while self.stats.n_bytes > self.max_bytes and len(self._entries) > 0:
+            (token, name), (_, size) = self._entries.popitem(last=False)
+            self._remove_name(token, name)
+            self.stats.n_bytes -= size
+            self.stats.evictions += 1
+
+    def _remove_name(self, token: int, name: Hashable):
+        names = self._names[token]
+        names.discard(name)
+        if len(names) == 0:
+            del self._names[token]
+
+    def discard(self, token: int):
+        """Drop all entries of a token."""
+        with self._lock:
+            for name in self._names.pop(token, ()):
+                self.stats.n_bytes -= self._entries.pop((token, name))[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._names.clear()
+            self.stats.n_bytes = 0
+
+    def resize(self, max_bytes: int):
+        """Change the byte budget and evict entries if needed."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+
+ATTRS_CACHE = _AttrsCache()
+
+
+class _cached_attr:
+    """Like `functools.cached_property`, but cached in `ATTRS_CACHE`."""
+
+    def __init__(self, func: Callable):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        token = ATTRS_CACHE.token(obj)
+        return ATTRS_CACHE.get(token, self.name, lambda: self.func(obj))
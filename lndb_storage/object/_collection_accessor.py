@@ -0,0 +1,324 @@
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from anndata import AnnData
+from anndata._core.index import Index
+from lamindb_setup.dev.upath import UPath
+from lnschema_core import File
+
+from .._parallel import map_ordered
+from ._anndata_accessor import AnnDataAccessor
+from ._attrs_cache import _cached_attr
+from ._read_coalesced import _read_elem_coalesced
+from ._selection import (
+    Selection,
+    _compose_indices,
+    _selection_len,
+    _selection_names,
+)
+
+
+def _join_var_names(var_names: List[pd.Index], join: str) -> pd.Index:
+    # the same order of the variables as in anndata.concat
+    joined = var_names[0]
+    for names in var_names[1:]:
+        if join == "inner":
+            joined = joined.intersection(names)
+        else:
+            joined = joined.union(names)
+    return joined
+
+
+def _as_positions(sel: Selection, n: int) -> np.ndarray:
+    if isinstance(sel, slice):
+        return np.arange(n, dtype=np.int64)[sel]
+    return sel
+
+
+def _align_block(block, columns: np.ndarray, n_vars: int, is_sparse: bool):
+    """Move the columns of a block to `columns`, fill the missing variables.
+
+    Like in `anndata.concat`, missing values are `nan` in dense results
+    and zeros in sparse results.
+    """
+    if sparse.issparse(block) or is_sparse:
+        block = sparse.csr_matrix(block)
+        block = sparse.csr_matrix(
+            (block.data, columns[block.indices], block.indptr),
+            shape=(block.shape[0], n_vars),
+        )
+        block.sort_indices()
+        return block
+    block = np.asarray(block)
+    dtype = np.result_type(block.dtype, np.float32)
+    aligned = np.full((block.shape[0], n_vars), np.nan, dtype=dtype)
+    aligned[:, columns] = block
+    return aligned
+
+
+def _reorder(result, file_rows: List[tuple]):
+    """Restore the order of the selected rows after reading file by file."""
+    order = np.concatenate([rows for _, _, rows in file_rows])
+    if np.any(order != np.arange(len(order))):
+        inverse = np.argsort(order, kind="stable")
+        if isinstance(result, pd.DataFrame):
+            return result.iloc[inverse]
+        return result[inverse]
+    return result
+
+
+class _CollectionMapAccessor:
+    def __init__(self, collection, name: str, keys: List[str]):
+        self.collection = collection
+        self.name = name
+        self._keys = keys
+
+    def __getitem__(self, key: str):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self.collection._read(
+            f"{self.name}/{key}", align_vars=self.name != "obsm"
+        )
+
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    def __repr__(self):
+        """Description of the _CollectionMapAccessor object."""
+        descr = f"Accessor for the AnnData attribute {self.name} of a collection"
+        descr += f"\n  with keys: {self.keys()}"
+        return descr
+
+
+class AnnDataCollectionAccessor:
+    """Access stored AnnData objects as one object concatenated along `obs`.
+
+    Nothing is read from the arrays until an attribute is accessed.
+    Subsets with integer, boolean and name indices are routed
+    to the files which contain the selected observations
+    and the touched files are read concurrently.
+
+    Args:
+        files: The files or accessors to concatenate.
+        join: `"inner"` or `"outer"` join of the variables like in `anndata.concat`,
+            missing values of dense arrays are `nan` in an outer join.
+        index_unique: Make the names of observations unique by appending
+            this separator and the position of the file.
+        max_workers: The number of threads to open and read the files.
+        **kwargs: Passed to `AnnDataAccessor` for files.
+    """
+
+    def __init__(
+        self,
+        files: Sequence[Union[File, str, Path, UPath, AnnDataAccessor]],
+        join: str = "inner",
+        index_unique: Optional[str] = None,
+        max_workers: Optional[int] = None,
+        **kwargs,
+    ):
+        if join not in ("inner", "outer"):
+            raise ValueError(f"join should be 'inner' or 'outer', not {join}.")
+        if len(files) == 0:
+            raise ValueError("Pass at least one file.")
+
+        def open_accessor(file):
+            if isinstance(file, AnnDataAccessor):
+                return file
+            return AnnDataAccessor(file, **kwargs)
+
+        self._accessors: List[AnnDataAccessor] = list(
+            map_ordered(open_accessor, files, max_workers=max_workers)
+        )
+        self.join = join
+        self.max_workers = max_workers
+
+        n_obs = [accessor.shape[0] for accessor in self._accessors]
+        self._offsets = np.concatenate(([0], np.cumsum(n_obs))).astype(np.int64)
+        obs_names = []
+        for i, accessor in enumerate(self._accessors):
+            names = accessor.obs_names
+            if index_unique is not None:
+                names = names.astype(str) + f"{index_unique}{i}"
+            obs_names.append(names)
+        self._obs_ref = pd.Index(np.concatenate(obs_names))
+
+        file_var_names = [accessor.var_names for accessor in self._accessors]
+        self._var_ref = _join_var_names(file_var_names, join)
+        # the positions of the joined variables in every file, -1 if missing
+        self._var_maps = [names.get_indexer(self._var_ref) for names in file_var_names]
+
+        self.indices = (slice(None), slice(None))
+
+    @classmethod
+    def _subset(cls, parent: "AnnDataCollectionAccessor", indices: tuple):
+        subset = cls.__new__(cls)
+        subset.__dict__.update(
+            {
+                key: value
+                for key, value in parent.__dict__.items()
+                if key != "_attrs_cache_token"
+            }
+        )
+        subset.indices = indices
+        return subset
+
+    def __getitem__(self, index: Index) -> "AnnDataCollectionAccessor":
+        """Access a subset of the concatenated AnnData objects."""
+        indices = _compose_indices(self.indices, index, self._obs_ref, self._var_ref)
+        return self._subset(self, indices)
+
+    @property
+    def obs_names(self) -> pd.Index:
+        return _selection_names(self.indices[0], self._obs_ref)
+
+    @property
+    def var_names(self) -> pd.Index:
+        return _selection_names(self.indices[1], self._var_ref)
+
+    @property
+    def shape(self) -> tuple:
+        n_obs = _selection_len(self.indices[0], len(self._obs_ref))
+        return n_obs, _selection_len(self.indices[1], len(self._var_ref))
+
+    @property
+    def accessors(self) -> List[AnnDataAccessor]:
+        return self._accessors
+
+    def _file_rows(self) -> List[tuple]:
+        """Split the selected rows into the positions in the touched files.
+
+        Returns the file, the positions in the file and the rows of the result.
+        """
+        positions = _as_positions(self.indices[0], len(self._obs_ref))
+        file_ids = np.searchsorted(self._offsets, positions, side="right") - 1
+        if len(file_ids) > 0 and np.all(file_ids[:-1] <= file_ids[1:]):
+            bounds = np.searchsorted(file_ids, np.arange(len(self._accessors) + 1))
+            rows = [np.arange(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+        else:
+            rows = [np.flatnonzero(file_ids == i) for i in range(len(self._accessors))]
+        return [
+            (i, positions[file_rows] - self._offsets[i], file_rows)
+            for i, file_rows in enumerate(rows)
+            if len(file_rows) > 0
+        ]
+
+    def _var_columns(self, i: int) -> tuple:
+        """The variables to read from a file and their columns in the result.
+
+        The columns are `None` if no variable is missing in the file.
+        """
+        var_map = self._var_maps[i][self.indices[1]]
+        present = var_map >= 0
+        var_idx = var_map[present]
+        n_file_vars = self._accessors[i].shape[1]
+        if len(var_idx) == n_file_vars and np.all(var_idx == np.arange(n_file_vars)):
+            var_idx = slice(None)
+        if np.all(present):
+            return var_idx, None
+        return var_idx, np.flatnonzero(present)
+
+    def _read_file(self, i: int, key: str, positions: np.ndarray, align_vars: bool):
+        storage = self._accessors[i].storage
+        group, _, elem_key = key.partition("/")
+        elem = storage[group][elem_key] if elem_key else storage[group]
+        if not align_vars:
+            return _read_elem_coalesced(elem, (positions, slice(None))), None
+        var_idx, columns = self._var_columns(i)
+        return _read_elem_coalesced(elem, (positions, var_idx)), columns
+
+    def _read(self, key: str, align_vars: bool = True):
+        """Read the selected rows of an array from the touched files."""
+        file_rows = self._file_rows()
+        blocks = list(
+            map_ordered(
+                self._read_file,
+                [i for i, _, _ in file_rows],
+                [key] * len(file_rows),
+                [positions for _, positions, _ in file_rows],
+                [align_vars] * len(file_rows),
+                max_workers=self.max_workers,
+            )
+        )
+        if len(blocks) == 0:
+            return None
+        is_sparse = any(sparse.issparse(block) for block, _ in blocks)
+        n_vars = self.shape[1]
+        blocks = [
+            (
+                block
+                if columns is None
+                else _align_block(block, columns, n_vars, is_sparse)
+            )
+            for block, columns in blocks
+        ]
+        if is_sparse:
+            result = sparse.vstack(blocks, format="csr")
+        else:
+            result = np.concatenate([np.asarray(block) for block in blocks])
+        return _reorder(result, file_rows)
+
+    @_cached_attr
+    def X(self):
+        return self._read("X")
+
+    @_cached_attr
+    def obs(self) -> pd.DataFrame:
+        file_rows = self._file_rows()
+        dfs = []
+        for i, positions, _ in file_rows:
+            obs = self._accessors[i][positions].obs
+            dfs.append(obs.to_pandas() if hasattr(obs, "to_pandas") else obs)
+        if len(dfs) == 0:
+            return pd.DataFrame(index=self.obs_names)
+        obs = _reorder(pd.concat(dfs, join=self.join), file_rows)
+        obs.index = self.obs_names
+        return obs
+
+    @_cached_attr
+    def var(self) -> pd.DataFrame:
+        var_list = [accessor.var for accessor in self._accessors]
+        var_list = [v.to_pandas() if hasattr(v, "to_pandas") else v for v in var_list]
+        var = pd.concat(var_list, join="outer")
+        var = var[~var.index.duplicated()]
+        return var.loc[self.var_names]
+
+    def _common_keys(self, attr: str) -> List[str]:
+        keys = [set(accessor._attrs_keys.get(attr, [])) for accessor in self._accessors]
+        first = self._accessors[0]._attrs_keys.get(attr, [])
+        return [key for key in first if all(key in k for k in keys)]
+
+    @property
+    def layers(self) -> _CollectionMapAccessor:
+        return _CollectionMapAccessor(self, "layers", self._common_keys("layers"))
+
+    @property
+    def obsm(self) -> _CollectionMapAccessor:
+        return _CollectionMapAccessor(self, "obsm", self._common_keys("obsm"))
+
+    def to_memory(self) -> AnnData:
+        """Read the selection into an AnnData object."""
+        layers, obsm = self.layers, self.obsm
+        return AnnData(
+            X=self.X,
+            obs=self.obs,
+            var=self.var,
+            layers={key: layers[key] for key in layers.keys()},
+            obsm={key: obsm[key] for key in obsm.keys()},
+        )
+
+    def __repr__(self):
+        """Description of the AnnDataCollectionAccessor object."""
+        n_obs, n_vars = self.shape
+        descr = (
+            f"AnnDataCollectionAccessor object with n_obs × n_vars = {n_obs} × {n_vars}"
+        )
+        descr += f"\n  constructed for {len(self._accessors)} AnnData objects"
+        descr += f" with {self.join} join of the variables"
+        for attr in ("layers", "obsm"):
+            keys = self._common_keys(attr)
+            if len(keys) > 0:
+                descr += f"\n    {attr}: {keys}"
+        return descr
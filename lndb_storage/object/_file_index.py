@@ -0,0 +1,406 @@
+import ast
+import base64
+import hashlib
+import json
+import math
+import operator
+import re
+from pathlib import PurePosixPath
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+from lamindb_setup.dev.upath import infer_filesystem
+from lnschema_core import File
+from lnschema_core._core import filepath_from_file_or_folder
+
+from ._lazy_field import CompiledSelector, LazyField, LazyOperator, LazyProperty
+from ._metadata_cache import _storage_version
+
+# the sidecar index of a stored file is at the path of the file with this suffix
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 2
+# the maximum number of distinct values stored for a column
+MAX_VALUES = 1000
+# the false positive rate of the bloom filters on obs_names and var_names
+BLOOM_FPR = 0.01
+
+_CMP_OPS = {
+    operator.eq: "==",
+    operator.ne: "!=",
+    operator.lt: "<",
+    operator.le: "<=",
+    operator.gt: ">",
+    operator.ge: ">=",
+}
+_OP_FUNCS = {op: func for func, op in _CMP_OPS.items()}
+_FLIPPED = {"==": "==", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+_AST_OPS = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.In: "in",
+}
+
+
+def _index_path(filepath):
+    if isinstance(filepath, str):
+        return filepath.rstrip("/") + INDEX_SUFFIX
+    return filepath.with_name(filepath.name + INDEX_SUFFIX)
+
+
+def _bloom_positions(names, n_bits: int, n_hashes: int) -> np.ndarray:
+    hashes = np.array(
+        [
+            np.frombuffer(
+                hashlib.blake2b(str(name).encode(), digest_size=16).digest(),
+                dtype=np.uint64,
+            )
+            for name in names
+        ],
+        dtype=np.uint64,
+    ).reshape(-1, 2)
+    # double hashing, the overflow of uint64 is intended
+    steps = np.arange(n_hashes, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        positions = hashes[:, :1] + steps * hashes[:, 1:]
+    return positions % np.uint64(n_bits)
+
+
+def _build_bloom(names) -> dict:
+    n_names = max(len(names), 1)
+    n_bits = max(int(math.ceil(-n_names * math.log(BLOOM_FPR) / math.log(2) ** 2)), 8)
+    n_hashes = max(int(round(n_bits / n_names * math.log(2))), 1)
+    bits = np.zeros(n_bits, dtype=bool)
+    if len(names) > 0:
+        bits[_bloom_positions(names, n_bits, n_hashes).ravel()] = True
+    packed = base64.b64encode(np.packbits(bits).tobytes()).decode()
+    return dict(n_bits=n_bits, n_hashes=n_hashes, bits=packed)
+
+
+def _bloom_may_contain(bloom: dict, names) -> bool:
+    if len(names) == 0:
+        return False
+    packed = np.frombuffer(base64.b64decode(bloom["bits"]), dtype=np.uint8)
+    bits = np.unpackbits(packed)[: bloom["n_bits"]].astype(bool)
+    positions = _bloom_positions(names, bloom["n_bits"], bloom["n_hashes"])
+    return bool(np.any(np.all(bits[positions], axis=1)))
+
+
+def _to_json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    return None
+
+
+def _column_stats(column: pd.Series) -> Optional[dict]:
+    stats: dict = dict(has_na=bool(column.isna().any()))
+    dtype = column.dtype
+    # missing values of nullable and float columns are only counted in has_na
+    column = column.dropna()
+    if dtype.kind in "iuf" and not isinstance(dtype, pd.CategoricalDtype):
+        if len(column) > 0:
+            vmin, vmax = column.min(), column.max()
+            if dtype.kind == "f" and dtype.itemsize < 8:
+                # queried values are rounded to the precision of the column
+                # when compared, widen the bounds to not exclude them
+                ftype = np.dtype(f"f{dtype.itemsize}").type
+                vmin = np.nextafter(ftype(vmin), ftype(-np.inf))
+                vmax = np.nextafter(ftype(vmax), ftype(np.inf))
+            stats["min"] = _to_json_value(vmin)
+            stats["max"] = _to_json_value(vmax)
+            if stats["min"] is None or stats["max"] is None:
+                return None
+        return stats
+
+    if dtype.kind in "mM":
+        # the json values of dates can't be compared with the queried values
+        return None
+    values = pd.unique(column)
+    if len(values) > MAX_VALUES:
+        return None
+    values = [_to_json_value(value) for value in values]
+    if any(value is None for value in values):
+        return None
+    stats["values"] = values
+    return stats
+
+
+def _dataframe_index(df: pd.DataFrame) -> dict:
+    columns = {}
+    for name in df.columns:
+        try:
+            stats = _column_stats(df[name])
+        except (TypeError, ValueError):
+            # columns which can't be summarized are not pruned on
+            stats = None
+        if stats is not None:
+            columns[str(name)] = stats
+    return dict(
+        columns=columns,
+        column_names=[str(name) for name in df.columns],
+        names=_build_bloom(df.index),
+    )
+
+
+def build_index(obs: pd.DataFrame, var: pd.DataFrame) -> dict:
+    """Build the index of a file from its `obs` and `var` dataframes.
+
+    Stores the minimum and the maximum of numeric columns,
+    the values of other columns with at most `MAX_VALUES` distinct values
+    and bloom filters on the names.
+    """
+    return dict(
+        version=INDEX_VERSION,
+        n_obs=len(obs),
+        n_vars=len(var),
+        obs=_dataframe_index(obs),
+        var=_dataframe_index(var),
+    )
+
+
+def _object_version(fs, path: str) -> Optional[str]:
+    path = path.rstrip("/")
+    return _storage_version(fs, path, PurePosixPath(path).suffix)
+
+
+def _write_index_json(fs, path: str, index: dict):
+    # the index is only valid for the current version of the file
+    index["object_version"] = _object_version(fs, path)
+    with fs.open(_index_path(path), mode="w") as f:
+        json.dump(index, f)
+
+
+def write_index(obs: pd.DataFrame, var: pd.DataFrame, filepath, fs=None):
+    """Write the sidecar index of the file at `filepath`.
+
+    The index stores the version of the file and
+    is ignored if the file changes, write it after the file.
+    """
+    if fs is None:
+        fs, path = infer_filesystem(filepath)
+    else:
+        path = str(filepath)
+    _write_index_json(fs, path, build_index(obs, var))
+
+
+def read_index(filepath) -> Optional[dict]:
+    """Read the sidecar index of the file at `filepath`.
+
+    Returns `None` if there is no index or it doesn't describe
+    the current version of the file.
+    """
+    fs, path = infer_filesystem(filepath)
+    try:
+        with fs.open(_index_path(path), mode="r") as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    if index.get("version") != INDEX_VERSION:
+        return None
+    version = index.get("object_version")
+    if version is None or version != _object_version(fs, path):
+        return None
+    return index
+
+
+def _remove_index(filepath, fs=None):
+    """Remove the sidecar index of a file which is written without an index."""
+    if fs is None:
+        fs, path = infer_filesystem(filepath)
+    else:
+        path = str(filepath)
+    index_path = _index_path(path)
+    if fs.exists(index_path):
+        fs.rm(index_path)
+
+
+def _copy_index(source, target):
+    """Copy the sidecar index of a file to a copy of the file at `target`.
+
+    The index is written for the version of the copy,
+    the index at `target` is removed if `source` has no valid index.
+    """
+    index = read_index(source)
+    if index is None:
+        _remove_index(target)
+        return None
+    fs, path = infer_filesystem(target)
+    _write_index_json(fs, path, index)
+
+
+def _stats_may_match(stats: dict, op: str, value) -> bool:
+    if op == "in":
+        if isinstance(value, (str, bytes)) or not hasattr(value, "__iter__"):
+            return True
+        return any(_stats_may_match(stats, "==", v) for v in value)
+    value = _to_json_value(value)
+    if value is None:
+        return True
+    if op == "!=" and stats["has_na"]:
+        return True
+
+    compare = _OP_FUNCS[op]
+    try:
+        if "values" in stats:
+            return any(compare(v, value) for v in stats["values"])
+        if "min" not in stats:
+            # only missing values
+            return op == "!="
+        vmin, vmax = stats["min"], stats["max"]
+        if op == "==":
+            return vmin <= value <= vmax
+        elif op == "!=":
+            return not (vmin == vmax == value)
+        else:
+            # one of the bounds satisfies the comparison if any value does
+            return compare(vmin, value) or compare(vmax, value)
+    except TypeError:
+        return True
+
+
+def _condition_may_match(
+    attr_index: dict, name: str, op: str, value, is_index: bool = False
+) -> bool:
+    """Check if any row can satisfy `name op value`.
+
+    `name` is a column or the index of the dataframe if `is_index` is `True`.
+    """
+    if is_index:
+        if op == "==":
+            value = [value]
+        elif op != "in":
+            return True
+        if not hasattr(value, "__iter__") or isinstance(value, (str, bytes)):
+            return True
+        return _bloom_may_contain(attr_index["names"], list(value))
+    stats = attr_index["columns"].get(name)
+    if stats is None:
+        return True
+    return _stats_may_match(stats, op, value)
+
+
+def _is_const(node) -> bool:
+    return not hasattr(node, "evaluate")
+
+
+def _is_index_field(field: LazyField) -> bool:
+    # lazy.index is the index of the dataframe, lazy["index"] is a column
+    return field._as_attr and field.name == "index"
+
+
+def _selector_may_match(node, attr_index: dict) -> bool:
+    if isinstance(node, LazyOperator):
+        left, right, op = node._left, node._right, node._op
+        if op is operator.and_:
+            return _selector_may_match(left, attr_index) and _selector_may_match(
+                right, attr_index
+            )
+        elif op is operator.or_:
+            return _selector_may_match(left, attr_index) or _selector_may_match(
+                right, attr_index
+            )
+        elif op in _CMP_OPS:
+            if isinstance(left, LazyField) and _is_const(right):
+                return _condition_may_match(
+                    attr_index, left.name, _CMP_OPS[op], right, _is_index_field(left)
+                )
+            elif isinstance(right, LazyField) and _is_const(left):
+                return _condition_may_match(
+                    attr_index,
+                    right.name,
+                    _FLIPPED[_CMP_OPS[op]],
+                    left,
+                    _is_index_field(right),
+                )
+    elif isinstance(node, LazyProperty):
+        obj, args = node._obj, node._args
+        is_isin = node._name == "isin" and node._call and len(args) == 1
+        if is_isin and isinstance(obj, LazyField) and _is_const(args[0]):
+            return _condition_may_match(
+                attr_index, obj.name, "in", node._args[0], _is_index_field(obj)
+            )
+    return True
+
+
+def _ast_may_match(node, attr_index: dict, names: dict) -> bool:
+    if isinstance(node, ast.BoolOp):
+        results = (_ast_may_match(value, attr_index, names) for value in node.values)
+        return all(results) if isinstance(node.op, ast.And) else any(results)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        left_match = _ast_may_match(node.left, attr_index, names)
+        right_match = _ast_may_match(node.right, attr_index, names)
+        if isinstance(node.op, ast.BitAnd):
+            return left_match and right_match
+        return left_match or right_match
+    elif isinstance(node, ast.Compare):
+        operands = [node.left, *node.comparators]
+        for left, ast_op, right in zip(operands[:-1], node.ops, operands[1:]):
+            op = _AST_OPS.get(type(ast_op))
+            if op is None:
+                continue
+            if isinstance(left, ast.Name) and not isinstance(right, ast.Name):
+                name, value_node = names.get(left.id, left.id), right
+            elif isinstance(right, ast.Name) and op != "in":
+                name, value_node, op = names.get(right.id, right.id), left, _FLIPPED[op]
+            else:
+                continue
+            try:
+                value = ast.literal_eval(value_node)
+            except (ValueError, TypeError):
+                continue
+            # like in pandas, a column named index takes precedence over the index
+            is_index = name == "index" and name not in attr_index["column_names"]
+            if not _condition_may_match(attr_index, name, op, value, is_index):
+                return False
+    return True
+
+
+def _query_may_match(attr_index: dict, query) -> bool:
+    """Check if any row can match the query, `True` if this can't be determined."""
+    if query is None:
+        return True
+    if isinstance(query, CompiledSelector):
+        query = query.selector
+    if not isinstance(query, str):
+        return _selector_may_match(query, attr_index)
+
+    # replace the backticked column names with valid python names
+    names: dict = {}
+
+    def replace(match):
+        name = f"__column_{len(names)}"
+        names[name] = match.group(1)
+        return name
+
+    try:
+        tree = ast.parse(re.sub(r"`([^`]+)`", replace, query), mode="eval")
+    except SyntaxError:
+        return True
+    return _ast_may_match(tree.body, attr_index, names)
+
+
+def _file_may_match(
+    file: Union[File, str],
+    query_obs=None,
+    query_var=None,
+) -> bool:
+    """Check the sidecar index of a file to find out if the queries can match.
+
+    Returns `True` if there is no index.
+    """
+    if query_obs is None and query_var is None:
+        return True
+    if isinstance(file, File):
+        file = filepath_from_file_or_folder(file)
+    index = read_index(file)
+    if index is None:
+        return True
+    return _query_may_match(index["obs"], query_obs) and _query_may_match(
+        index["var"], query_var
+    )
@@ -0,0 +1,325 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, List, Optional, Union
+
+import h5py
+import numpy as np
+import pandas as pd
+import zarr
+from anndata._io.h5ad import read_dataframe_legacy as read_dataframe_legacy_h5
+from anndata._io.specs.registry import get_spec, read_elem, read_elem_partial
+from anndata._io.zarr import read_dataframe_legacy as read_dataframe_legacy_zarr
+from anndata.compat import _read_attr
+
+from ._anndata_sizes import _size_objects, _size_series
+from ._lazy_field import _selector_fields
+from ._read_coalesced import _read_elem_coalesced
+
+# the default byte budget of the cached columns of a lazy dataframe
+# None means no limit
+MAX_COLUMNS_BYTES: Optional[int] = None
+
+Rows = Union[None, slice, np.ndarray]
+
+
+def _normalize_rows(rows, n_rows: int) -> Rows:
+    """Convert a row selection to `None`, a slice with step 1 or positions."""
+    if rows is None:
+        return None
+    if isinstance(rows, slice):
+        start, stop, step = rows.indices(n_rows)
+        if step == 1:
+            if start == 0 and stop == n_rows:
+                return None
+            return slice(start, max(start, stop))
+    return np.arange(n_rows)[rows]
+
+
+def _read_rows(elem: Union[h5py.Dataset, zarr.Array], rows: Rows):
+    """Read selected rows of a stored array in the order of `rows`."""
+    if rows is None:
+        return read_elem(elem)
+    if isinstance(rows, slice):
+        return read_elem_partial(elem, indices=rows)
+    if len(rows) == 0:
+        return read_elem_partial(elem, indices=slice(0, 0))
+    # h5py needs increasing positions, the rows are reordered in memory
+    unique, inverse = np.unique(rows, return_inverse=True)
+    if elem.dtype.kind in "biufc":
+        values = _read_elem_coalesced(elem, (unique, slice(None)))
+    else:
+        start = unique[0]
+        span = slice(int(start), int(unique[-1]) + 1)
+        values = read_elem_partial(elem, indices=span)[unique - start]
+    return values[inverse]
+
+
+def _read_column(elem: Union[h5py.Dataset, zarr.Array, h5py.Group, zarr.Group], rows):
+    """Read selected rows of a column of a stored dataframe."""
+    if rows is None:
+        return read_elem(elem)
+    encoding_type = get_spec(elem).encoding_type
+    if encoding_type == "categorical":
+        # the categories are small, only the codes are read partially
+        return pd.Categorical.from_codes(
+            codes=_read_rows(elem["codes"], rows),
+            categories=read_elem(elem["categories"]),
+            ordered=bool(_read_attr(elem.attrs, "ordered")),
+        )
+    elif encoding_type in ("nullable-integer", "nullable-boolean"):
+        values = _read_rows(elem["values"], rows)
+        if "mask" in elem:
+            mask = _read_rows(elem["mask"], rows)
+        else:
+            mask = np.zeros(len(values), dtype=bool)
+        if encoding_type == "nullable-integer":
+            return pd.arrays.IntegerArray(values, mask=mask)
+        return pd.arrays.BooleanArray(values, mask=mask)
+    return _read_rows(elem, rows)
+
+
+def _read_dataframe(elem: Union[zarr.Array, h5py.Dataset, zarr.Group, h5py.Group]):
+    if isinstance(elem, zarr.Array):
+        return read_dataframe_legacy_zarr(elem)
+    elif isinstance(elem, h5py.Dataset):
+        return read_dataframe_legacy_h5(elem)
+    else:
+        return read_elem(elem)
+
+
+def _read_dataframe_partial(
+    elem: Union[h5py.Group, zarr.Group], columns: Optional[List[str]] = None, rows=None
+) -> pd.DataFrame:
+    """Read some columns and rows of a stored dataframe.
+
+    Unlike `read_elem_partial`, also reads nullable columns,
+    anndata has no partial readers for them.
+    """
+    index_key = _read_attr(elem.attrs, "_index")
+    if columns is None:
+        columns = list(_read_attr(elem.attrs, "column-order"))
+    rows = _normalize_rows(rows, elem[index_key].shape[0])
+    df = pd.DataFrame(
+        {name: _read_column(elem[name], rows) for name in columns},
+        index=_read_rows(elem[index_key], rows),
+        columns=columns,
+    )
+    if index_key != "_index":
+        df.index.name = index_key
+    return df
+
+
+def _is_lazy_dataframe_elem(elem) -> bool:
+    """Check if the columns of a stored dataframe can be read lazily."""
+    if not isinstance(elem, (h5py.Group, zarr.Group)):
+        return False
+    spec = get_spec(elem)
+    return spec.encoding_type == "dataframe" and spec.encoding_version == "0.2.0"
+
+
+class _LazyDataFrame:
+    """Column by column access to a stored dataframe.
+
+    Columns are read on first access and cached, categorical columns
+    are decoded once. The least recently used columns are released
+    if the cached columns exceed `max_bytes`.
+    Boolean masks and lazy selectors return a lazy dataframe
+    for the selected rows, lazy selectors read only the columns they reference.
+    Other attributes of `pd.DataFrame` read the full dataframe.
+
+    This is not a `pd.DataFrame`, use `to_pandas` to get one.
+    """
+
+    def __init__(
+        self,
+        elem: Union[h5py.Group, zarr.Group],
+        rows=None,
+        max_bytes: Optional[int] = None,
+    ):
+        self._elem = elem
+        self._index_key = _read_attr(elem.attrs, "_index")
+        self._columns = list(_read_attr(elem.attrs, "column-order"))
+        self._n_stored = elem[self._index_key].shape[0]
+        self._rows = _normalize_rows(rows, self._n_stored)
+        self.max_bytes = max_bytes if max_bytes is not None else MAX_COLUMNS_BYTES
+
+        self._index: Optional[pd.Index] = None
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = Lock()
+        # called with the dataframe and the bytes of the cached columns if they change
+        self._size_listener: Optional[Callable] = None
+
+    @property
+    def columns(self) -> pd.Index:
+        return pd.Index(self._columns)
+
+    @property
+    def index(self) -> pd.Index:
+        if self._index is None:
+            index_name = self._index_key if self._index_key != "_index" else None
+            values = _read_rows(self._elem[self._index_key], self._rows)
+            self._set_index(pd.Index(values, name=index_name))
+        return self._index
+
+    def _report_size(self, cache_bytes: int):
+        if self._size_listener is not None:
+            self._size_listener(self, cache_bytes)
+
+    def _set_index(self, index: pd.Index):
+        with self._lock:
+            if self._index is not None:
+                return None
+            self._index = index
+            # the index is counted in the cached bytes, but never released
+            self._cache_bytes += _size_objects(index)
+            cache_bytes = self._cache_bytes
+        self._report_size(cache_bytes)
+
+    @property
+    def shape(self) -> tuple:
+        return len(self), len(self._columns)
+
+    def __len__(self) -> int:
+        """The number of rows."""
+        rows = self._rows
+        if rows is None:
+            return self._n_stored
+        elif isinstance(rows, slice):
+            return rows.stop - rows.start
+        return len(rows)
+
+    def __contains__(self, key) -> bool:
+        """Check if a column exists."""
+        return key in self._columns
+
+    def __iter__(self):
+        """Iterate over the column names like a dataframe."""
+        return iter(self._columns)
+
+    def keys(self) -> pd.Index:
+        return self.columns
+
+    def _cache_column(self, name: str, values):
+        with self._lock:
+            if name in self._cache:
+                return None
+            self._cache[name] = values
+            self._cache_bytes += _size_series(pd.Series(values, copy=False))
+            if self.max_bytes is not None:
+                # the column which was just added is always kept
+                while self._cache_bytes > self.max_bytes and len(self._cache) > 1:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= _size_series(pd.Series(evicted, copy=False))
+            cache_bytes = self._cache_bytes
+        self._report_size(cache_bytes)
+
+    def _column_values(self, name: str):
+        with self._lock:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                return self._cache[name]
+        if name not in self._columns:
+            raise KeyError(name)
+        values = _read_column(self._elem[name], self._rows)
+        self._cache_column(name, values)
+        return values
+
+    def _column(self, name: str) -> pd.Series:
+        return pd.Series(self._column_values(name), index=self.index, name=name)
+
+    def _select(self, positions: np.ndarray) -> "_LazyDataFrame":
+        """Get a lazy dataframe of the rows at `positions` of this dataframe."""
+        rows = self._rows
+        if rows is None:
+            new_rows = positions
+        elif isinstance(rows, slice):
+            new_rows = positions + rows.start
+        else:
+            new_rows = rows[positions]
+        selected = type(self)(self._elem, new_rows, self.max_bytes)
+        # the cached columns don't need to be read again
+        with self._lock:
+            cached = list(self._cache.items())
+        for name, values in cached:
+            selected._cache_column(name, values[positions])
+        if self._index is not None:
+            selected._set_index(self._index[positions])
+        return selected
+
+    def _evaluate(self, selector) -> np.ndarray:
+        """Evaluate a lazy selector on the columns it references."""
+        names = [
+            field.name
+            for field in _selector_fields(selector)
+            if field.name in self._columns
+        ]
+        df = pd.DataFrame(
+            {name: self._column_values(name) for name in names},
+            index=self.index,
+            columns=names,
+        )
+        mask = selector.evaluate(obj=df)
+        if hasattr(mask, "fillna"):
+            # missing values aren't selected like in pandas
+            mask = mask.fillna(False)
+        return np.asarray(mask, dtype=bool)
+
+    def __getitem__(self, key):
+        """Get a column, a dataframe of columns or a lazy subset of rows."""
+        if isinstance(key, str):
+            return self._column(key)
+        if hasattr(key, "evaluate"):
+            key = self._evaluate(key)
+        if isinstance(key, slice):
+            return self._select(np.arange(len(self))[key])
+        if isinstance(key, pd.Series) and key.dtype == bool:
+            key = key.to_numpy()
+        if isinstance(key, np.ndarray) and key.dtype == bool:
+            if len(key) != len(self):
+                raise IndexError(
+                    f"The mask has length {len(key)}, but the dataframe has"
+                    f" {len(self)} rows."
+                )
+            return self._select(np.flatnonzero(key))
+        if isinstance(key, (list, pd.Index)):
+            return pd.DataFrame(
+                {name: self._column_values(name) for name in key},
+                index=self.index,
+                columns=list(key),
+            )
+        raise KeyError(key)
+
+    def __getattr__(self, name: str):
+        """Access columns as attributes, otherwise fall back to `pd.DataFrame`."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._columns:
+            return self._column(name)
+        if hasattr(pd.DataFrame, name):
+            return getattr(self.to_pandas(), name)
+        raise AttributeError(f"'{type(self).__name__}' has no attribute '{name}'")
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        return self._select(np.arange(min(n, len(self)))).to_pandas()
+
+    def to_pandas(self) -> pd.DataFrame:
+        """Read all columns into a `pd.DataFrame`."""
+        return self[self._columns]
+
+    def __repr__(self):
+        """Description of the _LazyDataFrame object."""
+        n_rows, n_columns = self.shape
+        descr = f"Lazy dataframe with {n_rows} rows × {n_columns} columns"
+        descr += f"\n  columns: {self._columns}"
+        descr += f"\n  cached: {list(self._cache.keys())}"
+        return descr
+
+
+def _lazy_dataframe(elem, rows=None) -> Union[pd.DataFrame, _LazyDataFrame]:
+    """Get a lazy dataframe, legacy dataframes are read fully."""
+    if _is_lazy_dataframe_elem(elem):
+        return _LazyDataFrame(elem, rows)
+    if rows is None:
+        return _read_dataframe(elem)
+    return read_elem_partial(elem, indices=(rows, slice(None)))
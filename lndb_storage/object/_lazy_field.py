@@ -1,5 +1,7 @@
 import operator
-from typing import Union
+from typing import Any, Dict, List, Set, Tuple, Union
+
+import numpy as np
 
 # todo: add all operators
 BINARY_OPS = [
@@ -53,6 +55,10 @@ class MetaCatchOperators(type):
 class CatchAccess:
     def __getattr__(self, prop):
         """Catch a property and return `LazyProperty`."""
+        # dunder lookups like __getstate__ are needed for pickling
+        # the selectors to send them to process pools
+        if prop.startswith("__") and prop.endswith("__"):
+            raise AttributeError(prop)
         return LazyProperty(self, prop)
 
     def __array_function__(self, func, types, args, kwargs):
@@ -154,5 +160,157 @@ class Lazy:
         return LazyField(key, as_attr=False)
 
 
+def _selector_fields(selector) -> Set[LazyField]:
+    """Get all `LazyField` objects referenced by a lazy selector."""
+    if isinstance(selector, CompiledSelector):
+        return set(selector.fields)
+    elif isinstance(selector, LazyField):
+        return {selector}
+    elif isinstance(selector, LazyOperator):
+        return _selector_fields(selector._left) | _selector_fields(selector._right)
+    elif isinstance(selector, LazyProperty):
+        return _selector_fields(selector._obj)
+    elif isinstance(selector, LazyNumpyFunc):
+        fields: Set[LazyField] = set()
+        for arg in (*selector._args, *selector._kwargs.values()):
+            fields |= _selector_fields(arg)
+        return fields
+    else:
+        return set()
+
+
+_LAZY_TYPES = (LazyField, LazyOperator, LazyProperty, LazyNumpyFunc)
+
+
+def _const_key(value) -> Tuple[Any, ...]:
+    if isinstance(value, np.ndarray) and value.dtype.kind in "biufcSU":
+        return ("const_array", value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, list):
+        value_key = tuple(value)
+    else:
+        value_key = value
+    try:
+        hash(value_key)
+    except TypeError:
+        # other unhashable constants are only shared by identity
+        return ("const_id", id(value))
+    return ("const", type(value), value_key)
+
+
+class CompiledSelector:
+    """A lazy selector compiled into a flat plan.
+
+    Every distinct subexpression of the selector is evaluated only once
+    and subexpressions without fields are evaluated at compilation.
+    Evaluates to the same result as the selector and
+    can be reused for many objects, see `compile_selector`.
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        # values of the slots before evaluation, constants are set here
+        self._init: List[Any] = []
+        self._is_const: List[bool] = []
+        # (slot, kind, payload, arg slots, kwarg slots)
+        self._steps: List[tuple] = []
+        self.fields: List[LazyField] = []
+        self._slots: Dict[tuple, int] = {}
+        self._out = self._compile(selector)
+        del self._slots
+
+    def _new_slot(self, key: tuple, value=None, is_const: bool = False) -> int:
+        slot = len(self._init)
+        self._init.append(value)
+        self._is_const.append(is_const)
+        self._slots[key] = slot
+        return slot
+
+    def _add_step(self, key, kind, payload, args=(), kwargs=None) -> int:
+        if key in self._slots:
+            return self._slots[key]
+        kwargs = {} if kwargs is None else kwargs
+        slots = (*args, *kwargs.values())
+        if kind != "field" and all(self._is_const[slot] for slot in slots):
+            # constant folding
+            step = (None, kind, payload, args, kwargs)
+            value = self._run_step(step, self._init, None)
+            return self._new_slot(key, value, is_const=True)
+        slot = self._new_slot(key)
+        self._steps.append((slot, kind, payload, args, kwargs))
+        return slot
+
+    def _compile(self, node) -> int:
+        key: Tuple[Any, ...]
+        if isinstance(node, LazyField):
+            key = ("field", node.name, node._as_attr)
+            if key not in self._slots:
+                self.fields.append(node)
+            return self._add_step(key, "field", (node.name, node._as_attr))
+        elif isinstance(node, LazyOperator):
+            left = self._compile(node._left)
+            if node._right is None:
+                key = ("unary", node._op, left)
+                return self._add_step(key, "unary", node._op, (left,))
+            right = self._compile(node._right)
+            key = ("binary", node._op, left, right)
+            return self._add_step(key, "binary", node._op, (left, right))
+        elif isinstance(node, LazyProperty):
+            obj = self._compile(node._obj)
+            payload = (node._name, node._call, node._args, node._kwargs)
+            key = (
+                "property",
+                obj,
+                node._name,
+                node._call,
+                _const_key(node._args),
+                _const_key(tuple(node._kwargs.items())),
+            )
+            return self._add_step(key, "property", payload, (obj,))
+        elif isinstance(node, LazyNumpyFunc):
+            args = tuple(self._compile(arg) for arg in node._args)
+            kwargs = {name: self._compile(val) for name, val in node._kwargs.items()}
+            key = ("numpy", node._func, args, tuple(kwargs.items()))
+            return self._add_step(key, "numpy", node._func, args, kwargs)
+        else:
+            key = _const_key(node)
+            if key in self._slots:
+                return self._slots[key]
+            return self._new_slot(key, node, is_const=True)
+
+    @staticmethod
+    def _run_step(step: tuple, values: list, obj):
+        _, kind, payload, args, kwargs = step
+        if kind == "field":
+            name, as_attr = payload
+            return getattr(obj, name) if as_attr else obj[name]
+        elif kind == "binary":
+            return payload(values[args[0]], values[args[1]])
+        elif kind == "unary":
+            return payload(values[args[0]])
+        elif kind == "property":
+            name, call, call_args, call_kwargs = payload
+            attr = getattr(values[args[0]], name)
+            return attr(*call_args, **call_kwargs) if call else attr
+        else:
+            kwargs_eval = {key: values[slot] for key, slot in kwargs.items()}
+            return payload(*(values[slot] for slot in args), **kwargs_eval)
+
+    def evaluate(self, obj):
+        values = list(self._init)
+        for step in self._steps:
+            values[step[0]] = self._run_step(step, values, obj)
+        return values[self._out]
+
+
+def compile_selector(selector):
+    """Compile a lazy selector into a `CompiledSelector`.
+
+    Returns other objects, like query strings, as they are.
+    """
+    if isinstance(selector, _LAZY_TYPES):
+        return CompiledSelector(selector)
+    return selector
+
+
 lazy = Lazy()
-LazySelector = Union[LazyOperator, LazyProperty, LazyNumpyFunc]
+LazySelector = Union[LazyOperator, LazyProperty, LazyNumpyFunc, CompiledSelector]
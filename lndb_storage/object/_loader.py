@@ -0,0 +1,257 @@
+import time
+from threading import Lock
+from typing import Generator, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+import scipy.sparse as sparse
+
+from .._parallel import map_ordered
+from ._anndata_accessor import AnnDataAccessor, AnnDataAccessorSubset
+from ._anndata_sizes import _size_val
+from ._read_coalesced import _read_elem_coalesced
+
+# the default number of contiguous rows which are read at once
+BLOCK_SIZE = 4096
+
+Accessor = Union[AnnDataAccessor, AnnDataAccessorSubset]
+
+
+class LoaderStats:
+    """Throughput of an `AnnDataLoader`, updated while iterating.
+
+    `n_bytes` are the bytes of the decoded minibatches.
+    """
+
+    def __init__(self):
+        self.n_rows = 0
+        self.n_bytes = 0
+        self.seconds = 0.0
+        self._lock = Lock()
+
+    def add(self, n_rows: int, n_bytes: int, seconds: float = 0.0):
+        with self._lock:
+            self.n_rows += n_rows
+            self.n_bytes += n_bytes
+            self.seconds += seconds
+
+    def reset(self):
+        with self._lock:
+            self.n_rows = 0
+            self.n_bytes = 0
+            self.seconds = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.n_rows / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.n_bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        """Description of the LoaderStats object."""
+        return (
+            f"LoaderStats(n_rows={self.n_rows}, n_bytes={self.n_bytes},"
+            f" rows_per_second={self.rows_per_second:.1f},"
+            f" bytes_per_second={self.bytes_per_second:.1f})"
+        )
+
+
+def _accessor_rows(accessor: Accessor) -> tuple:
+    """The stored positions of the rows and the columns of an accessor."""
+    if isinstance(accessor, AnnDataAccessor):
+        return np.arange(accessor.shape[0]), slice(None)
+    oidx, vidx = accessor._selection
+    positions = np.arange(accessor._ref_shape[0])[oidx]
+    return positions, vidx
+
+
+class AnnDataLoader:
+    """Iterate over shuffled minibatches of stored AnnData objects.
+
+    Shuffles the order of blocks of `block_size` contiguous rows,
+    so that every block is fetched with a few range reads,
+    and then shuffles the rows of `shuffle_blocks` blocks in memory.
+    Upcoming blocks are read on `max_workers` background threads.
+
+    Yields dictionaries with the rows of `.X` or of a layer under `"X"`
+    as a csr matrix or a dense array and the values of `obs_keys`.
+
+    Args:
+        accessors: One or more accessors with the same variables,
+            also subsets of accessors.
+        batch_size: The number of rows of a minibatch.
+        shuffle: Shuffle the rows, otherwise iterate in order.
+        block_size: The number of contiguous rows which are read at once.
+        shuffle_blocks: The number of blocks which are shuffled together,
+            this bounds the number of rows held in memory.
+        layer: Read this layer instead of `.X`.
+        obs_keys: Columns of `.obs` which are added to the minibatches.
+        dense: Yield dense arrays instead of csr matrices.
+        drop_last: Skip the last minibatch if it is smaller than `batch_size`.
+        max_workers: The number of threads to prefetch blocks.
+        prefetch: The number of blocks which are read ahead.
+        seed: The seed of the random number generator.
+    """
+
+    def __init__(
+        self,
+        accessors: Union[Accessor, Sequence[Accessor]],
+        batch_size: int = 256,
+        shuffle: bool = True,
+        block_size: int = BLOCK_SIZE,
+        shuffle_blocks: int = 4,
+        layer: Optional[str] = None,
+        obs_keys: Optional[List[str]] = None,
+        dense: bool = False,
+        drop_last: bool = False,
+        max_workers: int = 2,
+        prefetch: int = 4,
+        seed: Optional[int] = None,
+    ):
+        if isinstance(accessors, (AnnDataAccessor, AnnDataAccessorSubset)):
+            accessor_list: List[Accessor] = [accessors]
+        else:
+            accessor_list = list(accessors)
+        if len(accessor_list) == 0:
+            raise ValueError("Pass at least one accessor.")
+        if len({accessor.shape[1] for accessor in accessor_list}) > 1:
+            raise ValueError("All accessors should have the same number of variables.")
+        if batch_size < 1 or block_size < 1:
+            raise ValueError("batch_size and block_size should be positive.")
+
+        self.accessors = accessor_list
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self.shuffle_blocks = max(shuffle_blocks, 1)
+        self.layer = layer
+        self.obs_keys = obs_keys
+        self.dense = dense
+        self.drop_last = drop_last
+        self.max_workers = max_workers
+        self.prefetch = prefetch
+        self.stats = LoaderStats()
+        self._rng = np.random.default_rng(seed)
+
+        self._rows = [_accessor_rows(accessor) for accessor in self.accessors]
+        self._obs = None
+        if obs_keys is not None:
+            self._obs = [accessor.obs[obs_keys] for accessor in self.accessors]
+        # (accessor, start, stop) of the blocks in the rows of the accessors
+        self._blocks = [
+            (i, start, min(start + block_size, accessor.shape[0]))
+            for i, accessor in enumerate(self.accessors)
+            for start in range(0, accessor.shape[0], block_size)
+        ]
+
+    def __len__(self) -> int:
+        """The number of minibatches."""
+        n_obs = sum(accessor.shape[0] for accessor in self.accessors)
+        if self.drop_last:
+            return n_obs // self.batch_size
+        return -(-n_obs // self.batch_size)
+
+    def _elem(self, i: int):
+        storage = self.accessors[i].storage
+        if self.layer is None:
+            return storage["X"]
+        return storage["layers"][self.layer]
+
+    def _read_block(self, i: int, start: int, stop: int) -> dict:
+        positions, var_idx = self._rows[i]
+        # the positions of contiguous rows are coalesced into range reads,
+        # slices of sparse arrays would be read row by row by anndata
+        X = _read_elem_coalesced(self._elem(i), (positions[start:stop], var_idx))
+        if sparse.issparse(X):
+            X = sparse.csr_matrix(X)
+        else:
+            X = np.asarray(X)
+        block = dict(X=X)
+        if self._obs is not None:
+            obs = self._obs[i].iloc[start:stop]
+            for key in self.obs_keys:  # type: ignore
+                block[key] = obs[key].to_numpy()
+        return block
+
+    def _batches(self, blocks: List[dict]) -> Iterator[dict]:
+        """Split concatenated blocks into minibatches."""
+        X = [block["X"] for block in blocks]
+        if any(sparse.issparse(x) for x in X):
+            X = sparse.vstack(X, format="csr")
+        else:
+            X = np.concatenate(X)
+        n_rows = X.shape[0]
+        order = self._rng.permutation(n_rows) if self.shuffle else np.arange(n_rows)
+        columns = {
+            key: np.concatenate([block[key] for block in blocks])
+            for key in blocks[0]
+            if key != "X"
+        }
+        for start in range(0, n_rows, self.batch_size):
+            idx = order[start : start + self.batch_size]
+            batch_X = X[idx]
+            if self.dense and sparse.issparse(batch_X):
+                batch_X = batch_X.toarray()
+            elif not self.dense and not sparse.issparse(batch_X):
+                batch_X = sparse.csr_matrix(batch_X)
+            batch = dict(X=batch_X)
+            for key, values in columns.items():
+                batch[key] = values[idx]
+            yield batch
+
+    def __iter__(self) -> Iterator[dict]:
+        """Iterate over the minibatches of one epoch.
+
+        Adds the rows and the bytes of the minibatches to `stats`
+        with the time spent to produce them, without the time of the consumer.
+        """
+        batches = self._iter_epoch()
+        try:
+            while True:
+                begin = time.perf_counter()
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                X = batch["X"]
+                self.stats.add(X.shape[0], _size_val(X), time.perf_counter() - begin)
+                yield batch
+        finally:
+            batches.close()
+
+    def _iter_epoch(self) -> Generator[dict, None, None]:
+        blocks = self._blocks
+        if self.shuffle:
+            blocks = [blocks[i] for i in self._rng.permutation(len(blocks))]
+        read = map_ordered(
+            self._read_block,
+            [block[0] for block in blocks],
+            [block[1] for block in blocks],
+            [block[2] for block in blocks],
+            max_workers=self.max_workers,
+            max_in_flight=self.prefetch,
+        )
+
+        # rows left over from the previous group of blocks
+        pending: Optional[dict] = None
+        group: List[dict] = []
+        for block in read:
+            group.append(block)
+            if len(group) < self.shuffle_blocks:
+                continue
+            pending = yield from self._yield_group(group, pending)
+            group = []
+        if len(group) > 0:
+            pending = yield from self._yield_group(group, pending)
+        if pending is not None and not self.drop_last:
+            yield pending
+
+    def _yield_group(self, group: List[dict], pending: Optional[dict]):
+        """Yield the full minibatches of a group and return the rest."""
+        if pending is not None:
+            group = [pending] + group
+        for batch in self._batches(group):
+            if batch["X"].shape[0] < self.batch_size:
+                return batch
+            yield batch
+        return None
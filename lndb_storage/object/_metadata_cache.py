@@ -0,0 +1,99 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from pathlib import Path, PurePosixPath
+from typing import Callable, Optional
+
+from lamin_logger import logger
+from lamindb_setup import settings
+
+# overwrites the default cache directory if set
+METADATA_CACHE_DIR: Optional[Path] = None
+
+_VERSION_KEYS = ("ETag", "etag", "md5Hash", "LastModified", "updated", "mtime", "size")
+
+
+def _metadata_cache_dir() -> Optional[Path]:
+    if METADATA_CACHE_DIR is not None:
+        return Path(METADATA_CACHE_DIR)
+    try:
+        cache_dir = settings.instance.storage.cache_dir
+    except Exception:
+        return None
+    if cache_dir is None:
+        return None
+    return Path(cache_dir) / "_lndb_storage_metadata"
+
+
+def _info_version(info: dict) -> Optional[str]:
+    version = [str(info[key]) for key in _VERSION_KEYS if info.get(key) is not None]
+    # size alone is not enough to detect changes
+    if len(version) < 2:
+        return None
+    return "-".join(version)
+
+
+def _storage_version(fs, path: str, suffix: str) -> Optional[str]:
+    """Get a token which changes if the stored object changes."""
+    if suffix not in (".zarr", ".zrad"):
+        try:
+            return _info_version(fs.info(path))
+        except FileNotFoundError:
+            return None
+    # the consolidated metadata changes if any array of a zarr store is rewritten,
+    # the root attributes are rewritten on every write of anndata
+    # a single listing gets both
+    try:
+        infos = fs.ls(path, detail=True)
+    except FileNotFoundError:
+        return None
+    infos = {PurePosixPath(info["name"]).name: info for info in infos}
+    versions = []
+    for key in (".zmetadata", ".zattrs"):
+        if key not in infos:
+            continue
+        version = _info_version(infos[key])
+        if version is None:
+            return None
+        versions.append(version)
+    if len(versions) == 0:
+        return None
+    return "|".join(versions)
+
+
+def _cached_metadata(fs, path: str, suffix: str, read_metadata: Callable) -> dict:
+    """Get the metadata of a stored object from the local cache.
+
+    The cache is keyed by the path of the object and
+    is invalidated if the etag or the modification time of the object change.
+    Calls `read_metadata` on a cache miss and stores its result.
+    """
+    cache_dir = _metadata_cache_dir()
+    if cache_dir is None:
+        return read_metadata()
+    version = _storage_version(fs, path, suffix)
+    if version is None:
+        return read_metadata()
+
+    cache_file = cache_dir / (hashlib.sha1(path.encode()).hexdigest() + ".pkl")
+    if cache_file.exists():
+        try:
+            with open(cache_file, "rb") as f:
+                cached = pickle.load(f)
+            if cached["version"] == version:
+                return cached["metadata"]
+        except Exception as e:
+            logger.debug(f"Could not read the metadata cache {cache_file}: {e}")
+
+    metadata = read_metadata()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(
+            {"version": version, "metadata": metadata},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(tmp_file, cache_file)
+    return metadata
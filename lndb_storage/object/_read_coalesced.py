@@ -0,0 +1,129 @@
+from typing import List, Tuple, Union
+
+import h5py
+import numpy as np
+import scipy.sparse as sparse
+import zarr
+from anndata._io.specs.registry import get_spec, read_elem_partial
+
+# maximum number of bytes to read in a gap between two selected rows
+# if the underlying array is not chunked
+GAP_BYTES = 2**20
+
+
+def _coalesce_runs(positions: np.ndarray, mergeable: np.ndarray) -> List[Tuple]:
+    """Group sorted unique positions into `[start, stop)` runs.
+
+    Two consecutive positions end up in the same run
+    if the corresponding entry of `mergeable` is `True`.
+    """
+    breaks = np.flatnonzero(~mergeable) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(positions)]))
+    return [
+        (positions[i_start], positions[i_stop - 1] + 1, i_start, i_stop)
+        for i_start, i_stop in zip(starts, stops)
+    ]
+
+
+def _dense_runs(elem: Union[h5py.Dataset, zarr.Array], positions: np.ndarray):
+    chunks = elem.chunks
+    if chunks is not None:
+        # merge positions in the same or in adjacent chunks
+        chunk_ids = positions // chunks[0]
+        mergeable = np.diff(chunk_ids) <= 1
+    else:
+        row_bytes = elem.dtype.itemsize * int(np.prod(elem.shape[1:]))
+        mergeable = np.diff(positions) <= max(GAP_BYTES // max(row_bytes, 1), 1)
+    return _coalesce_runs(positions, mergeable)
+
+
+def _sparse_runs(indptr: np.ndarray, data, positions: np.ndarray):
+    chunks = getattr(data, "chunks", None)
+    if chunks is not None:
+        max_gap = chunks[0]
+    else:
+        max_gap = max(GAP_BYTES // data.dtype.itemsize, 1)
+    # the number of stored values between two selected rows
+    gap_nnz = indptr[positions[1:]] - indptr[positions[:-1] + 1]
+    return _coalesce_runs(positions, gap_nnz <= max_gap)
+
+
+def _read_dense_rows(elem: Union[h5py.Dataset, zarr.Array], positions, var_idx):
+    blocks = []
+    for start, stop, i_start, i_stop in _dense_runs(elem, positions):
+        if isinstance(var_idx, slice) and elem.ndim > 1:
+            block = elem[start:stop, var_idx]
+        else:
+            block = elem[start:stop]
+        blocks.append(block[positions[i_start:i_stop] - start])
+    result = np.concatenate(blocks)
+    if not isinstance(var_idx, slice):
+        result = result[:, var_idx]
+    return result
+
+
+def _read_csr_rows(elem: Union[h5py.Group, zarr.Group], positions, var_idx):
+    indptr = elem["indptr"][...]
+    data, indices = elem["data"], elem["indices"]
+    n_cols = elem.attrs["shape"][1]
+
+    blocks = []
+    for start, stop, i_start, i_stop in _sparse_runs(indptr, data, positions):
+        begin, end = indptr[start], indptr[stop]
+        block = sparse.csr_matrix(
+            (data[begin:end], indices[begin:end], indptr[start : stop + 1] - begin),
+            shape=(stop - start, n_cols),
+        )
+        blocks.append(block[positions[i_start:i_stop] - start])
+    result = sparse.vstack(blocks, format="csr")
+    if not (isinstance(var_idx, slice) and var_idx == slice(None)):
+        result = result[:, var_idx]
+    return result
+
+
+def _is_csr(elem) -> bool:
+    if not isinstance(elem, (h5py.Group, zarr.Group)):
+        return False
+    if "h5sparse_format" in elem.attrs:
+        return False
+    return get_spec(elem).encoding_type == "csr_matrix"
+
+
+def _read_elem_coalesced(elem, indices: tuple):
+    """Read a subset of an array element with coalesced row reads.
+
+    Instead of fancy indexing the element with the selected rows,
+    sorts the rows and groups them into contiguous runs
+    which fit the chunks of the element or the `indptr` of a csr matrix.
+    Every run is read with one range read and the rows are reordered in memory.
+
+    Falls back to `read_elem_partial` for other elements and for slices.
+    """
+    obs_idx, var_idx = indices
+    is_dense = isinstance(elem, (h5py.Dataset, zarr.Array)) and elem.ndim > 0
+    is_dense = is_dense and elem.dtype.kind in "biufc"
+    has_positions = isinstance(obs_idx, (list, np.ndarray)) and len(obs_idx) > 0
+    if not has_positions or not (is_dense or _is_csr(elem)):
+        return read_elem_partial(elem, indices=indices)
+
+    positions = np.asarray(obs_idx, dtype=np.int64)
+    if positions.ndim != 1:
+        return read_elem_partial(elem, indices=indices)
+    n_rows = elem.shape[0] if is_dense else elem.attrs["shape"][0]
+    positions = np.where(positions < 0, positions + n_rows, positions)
+    unique, inverse = np.unique(positions, return_inverse=True)
+
+    if is_dense:
+        result = _read_dense_rows(elem, unique, var_idx)
+    else:
+        result = _read_csr_rows(elem, unique, var_idx)
+
+    if len(unique) != len(positions) or np.any(unique != positions):
+        result = result[inverse]
+    return result
+
+
+def _read_partial_coalesced(group, indices: tuple) -> dict:
+    """Read subsets of all elements of a group, see `_read_elem_coalesced`."""
+    return {key: _read_elem_coalesced(group[key], indices) for key in group.keys()}
@@ -0,0 +1,160 @@
+from typing import Tuple, Union
+
+import numpy as np
+import pandas as pd
+from anndata._core.index import unpack_index
+from scipy.sparse import spmatrix
+
+# a selection of positions along an axis of the reference object,
+# slices with a non-negative step or int64 positions
+Selection = Union[slice, np.ndarray]
+
+
+def _as_index(names) -> pd.Index:
+    """Wrap names in an index, an existing index keeps its hash table."""
+    return names if isinstance(names, pd.Index) else pd.Index(names)
+
+
+def _selection_range(sel: slice, n_ref: int) -> range:
+    return range(*sel.indices(n_ref))
+
+
+def _range_to_selection(r: range) -> Selection:
+    if r.step < 0:
+        # h5py can't read slices with a negative step
+        return np.arange(r.start, r.stop, r.step, dtype=np.int64)
+    stop = r.start if len(r) == 0 else r.stop
+    return slice(r.start, stop, r.step)
+
+
+def _selection_len(sel: Selection, n_ref: int) -> int:
+    if isinstance(sel, slice):
+        return len(_selection_range(sel, n_ref))
+    return len(sel)
+
+
+def _selection_names(sel: Selection, ref_names: pd.Index) -> pd.Index:
+    if isinstance(sel, slice) and sel == slice(None):
+        return ref_names
+    return ref_names[sel]
+
+
+def _take(sel: Selection, positions: np.ndarray, n_ref: int) -> np.ndarray:
+    """Get the reference positions of the `positions` in a selection."""
+    if isinstance(sel, slice):
+        r = _selection_range(sel, n_ref)
+        return r.start + positions.astype(np.int64) * r.step
+    return sel[positions]
+
+
+def _check_in_selection(sel: Selection, positions: np.ndarray, n_ref: int):
+    if isinstance(sel, slice):
+        if sel == slice(None):
+            return None
+        r = _selection_range(sel, n_ref)
+        offset = positions - r.start
+        inside = (offset % r.step == 0) & (0 <= offset // r.step)
+        inside &= offset // r.step < len(r)
+    else:
+        inside = np.isin(positions, sel)
+    if not np.all(inside):
+        raise KeyError("Some of the names are not in the selection.")
+
+
+def _names_to_positions(names, ref_names: pd.Index) -> np.ndarray:
+    positions = ref_names.get_indexer(names)
+    if np.any(positions < 0):
+        not_found = np.asarray(names)[positions < 0]
+        raise KeyError(
+            f"Values {list(not_found)}, from {list(names)}, are not valid obs/ var"
+            " names or indices."
+        )
+    return positions.astype(np.int64)
+
+
+def _name_to_view(sel: Selection, name: str, ref_names: pd.Index, n_ref: int):
+    """Get the position of a name in a selection, for slices with names."""
+    position = _names_to_positions([name], ref_names)
+    _check_in_selection(sel, position, n_ref)
+    if isinstance(sel, slice):
+        r = _selection_range(sel, n_ref)
+        return (int(position[0]) - r.start) // r.step
+    return int(np.flatnonzero(sel == position[0])[0])
+
+
+def _compose(sel: Selection, key, ref_names: pd.Index) -> Selection:
+    """Select `key` in the selection `sel` of the reference names.
+
+    Slices of slices stay slices and names are resolved with the hash table
+    of the reference names, so only the selected positions are allocated.
+    """
+    n_ref = len(ref_names)
+    if isinstance(key, pd.Series):
+        key = key.values
+    if isinstance(key, slice):
+        if key == slice(None):
+            return sel
+        start, stop = key.start, key.stop
+        if isinstance(start, str):
+            start = _name_to_view(sel, start, ref_names, n_ref)
+        if isinstance(stop, str):
+            # slices with names include the stop
+            stop = _name_to_view(sel, stop, ref_names, n_ref) + 1
+        key = slice(start, stop, key.step)
+        if isinstance(sel, slice):
+            return _range_to_selection(_selection_range(sel, n_ref)[key])
+        return sel[key]
+    if isinstance(key, (int, np.integer)):
+        r_len = _selection_len(sel, n_ref)
+        position = int(key) + r_len if key < 0 else int(key)
+        if not 0 <= position < r_len:
+            raise IndexError(f"Index {key} is out of bounds for length {r_len}.")
+        return _take(sel, np.array([position], dtype=np.int64), n_ref)
+    if isinstance(key, str):
+        positions = _names_to_positions([key], ref_names)
+        _check_in_selection(sel, positions, n_ref)
+        return positions
+
+    if isinstance(key, spmatrix):
+        key = key.toarray()
+    key = np.asarray(key)
+    if key.ndim == 2 and 1 in key.shape:
+        key = key.ravel()
+    n_view = _selection_len(sel, n_ref)
+    if key.dtype == bool:
+        if key.shape != (n_view,):
+            raise IndexError(
+                "Boolean index does not match AnnData’s shape along this dimension."
+                f" Boolean index has shape {key.shape} while AnnData index has"
+                f" shape {(n_view,)}."
+            )
+        return _take(sel, np.flatnonzero(key), n_ref)
+    if key.dtype.kind in "iu":
+        positions = key.astype(np.int64)
+        positions = np.where(positions < 0, positions + n_view, positions)
+        if len(positions) > 0 and (positions.min() < 0 or positions.max() >= n_view):
+            raise IndexError(f"Positions are out of bounds for length {n_view}.")
+        return _take(sel, positions, n_ref)
+    if key.dtype.kind == "f":
+        raise IndexError("Can't select with floating point positions.")
+    positions = _names_to_positions(key, ref_names)
+    _check_in_selection(sel, positions, n_ref)
+    return positions
+
+
+def _compose_indices(
+    indices: Tuple[Selection, Selection],
+    index,
+    obs_ref: pd.Index,
+    var_ref: pd.Index,
+) -> Tuple[Selection, Selection]:
+    """Compose an index of an AnnData object with the selected positions."""
+    if isinstance(index, tuple) and len(index) == 1:
+        index = index[0]
+    if isinstance(index, tuple) and len(index) > 2:
+        raise ValueError("AnnData can only be sliced in rows and columns.")
+    oidx, vidx = unpack_index(index)
+    return (
+        _compose(indices[0], oidx, obs_ref),
+        _compose(indices[1], vidx, var_ref),
+    )
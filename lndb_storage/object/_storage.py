@@ -0,0 +1,411 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Iterator, Optional, Tuple, Union
+
+import h5py
+import zarr
+from lamindb_setup.dev.upath import infer_filesystem as _infer_filesystem
+from lnschema_core import File
+from lnschema_core._core import filepath_from_file_or_folder
+from zarr.storage import FSStore
+
+from ._metadata_cache import _storage_version
+
+# the default maximum number of concurrent requests to fetch zarr chunks
+MAX_CONCURRENCY = 32
+# the default caching of h5ad files opened over fsspec, see _open_h5ad
+H5AD_CACHE_OPTIONS = dict(cache_type="blockcache", block_size=2**21, max_blocks=32)
+# the default maximum number of open handles in the storage pool
+MAX_OPEN_HANDLES = 32
+# the default number of seconds after which unused handles are closed
+HANDLE_IDLE_TIMEOUT = 300.0
+# the default number of seconds for which a pooled handle is reused
+# without checking the version of the stored object
+HANDLE_CHECK_INTERVAL = 10.0
+
+
+class IOStats:
+    """Number of requests and bytes fetched from the storage."""
+
+    def __init__(self):
+        self.n_requests = 0
+        self.n_bytes = 0
+        self._lock = Lock()
+
+    def add(self, n_requests: int, n_bytes: int):
+        with self._lock:
+            self.n_requests += n_requests
+            self.n_bytes += n_bytes
+
+    def reset(self):
+        with self._lock:
+            self.n_requests = 0
+            self.n_bytes = 0
+
+    def __repr__(self):
+        """Description of the IOStats object."""
+        return f"IOStats(n_requests={self.n_requests}, n_bytes={self.n_bytes})"
+
+
+class _ConcurrentFSStore(FSStore):
+    """Read-only `FSStore` which fetches multiple chunks concurrently.
+
+    Uses the async interface of the filesystem with at most `max_concurrency`
+    simultaneous requests if possible, otherwise a thread pool.
+    """
+
+    def __init__(self, url, fs, max_concurrency: Optional[int] = None, **kwargs):
+        super().__init__(url, fs=fs, mode="r", **kwargs)
+        if max_concurrency is None:
+            max_concurrency = MAX_CONCURRENCY
+        self.max_concurrency = max(max_concurrency, 1)
+        self.io_stats = IOStats()
+
+    def __getitem__(self, key):
+        """Fetch a single key."""
+        value = super().__getitem__(key)
+        self.io_stats.add(1, len(value))
+        return value
+
+    def _cat_paths(self, paths: list) -> dict:
+        if getattr(self.fs, "async_impl", False):
+            out = self.fs.cat(paths, on_error="return", batch_size=self.max_concurrency)
+            if isinstance(out, bytes):
+                out = {paths[0]: out}
+            return out
+
+        def cat_file(path):
+            try:
+                return self.fs.cat_file(path)
+            except Exception as e:
+                return e
+
+        if len(paths) == 1 or self.max_concurrency == 1:
+            return {path: cat_file(path) for path in paths}
+        n_workers = min(self.max_concurrency, len(paths))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return dict(zip(paths, executor.map(cat_file, paths)))
+
+    def getitems(self, keys, **kwargs):
+        """Fetch multiple keys concurrently, missing keys are omitted."""
+        keys_transformed = [self._normalize_key(key) for key in keys]
+        paths = [self.map._key_to_str(key) for key in keys_transformed]
+        out = self._cat_paths(paths)
+        n_bytes = sum(len(v) for v in out.values() if not isinstance(v, BaseException))
+        self.io_stats.add(len(paths), n_bytes)
+
+        results = {}
+        for key, path in zip(keys, paths):
+            value = out[path]
+            if isinstance(value, BaseException):
+                if isinstance(value, self.exceptions):
+                    continue
+                raise value
+            results[key] = value
+        return results
+
+
+def _open_zarr(fs, path: str, max_concurrency: Optional[int] = None) -> zarr.Group:
+    """Open a zarr store for reading, with consolidated metadata if present.
+
+    With consolidated metadata, all groups and arrays are opened
+    and listed from a single request.
+    """
+    store = _ConcurrentFSStore(path, fs=fs, max_concurrency=max_concurrency)
+    try:
+        return zarr.open_consolidated(store, mode="r")
+    except KeyError:
+        return zarr.open(store, mode="r")
+
+
+def _open_h5ad(
+    fs, path: str, cache_options: Optional[dict] = None
+) -> Tuple[Any, h5py.File, IOStats]:
+    """Open an h5ad file with a read cache over fsspec.
+
+    `h5py` does many small reads of the file metadata,
+    the cache combines them into a few requests of `block_size` bytes.
+
+    Args:
+        fs: The filesystem.
+        path: The path of the file.
+        cache_options: Overwrites the defaults in `H5AD_CACHE_OPTIONS`.
+        `cache_type` is the name of an fsspec cache, it defines
+        the eviction policy, for example `"blockcache"` keeps
+        the `max_blocks` last used blocks, `"readahead"` only the last read,
+        `"none"` disables caching.
+
+    Returns the file object, the `h5py.File` and the request statistics.
+    """
+    options = {**H5AD_CACHE_OPTIONS, **(cache_options or {})}
+    cache_type = options["cache_type"]
+    open_kwargs = dict(cache_type=cache_type, block_size=options["block_size"])
+    if cache_type == "blockcache":
+        open_kwargs["cache_options"] = {"maxblocks": options["max_blocks"]}
+
+    conn = fs.open(path, mode="rb", **open_kwargs)
+    io_stats = IOStats()
+    cache = getattr(conn, "cache", None)
+    if cache is not None:
+        fetcher = cache.fetcher
+
+        def _fetch_counted(start, end):
+            data = fetcher(start, end)
+            io_stats.add(1, len(data))
+            return data
+
+        cache.fetcher = _fetch_counted
+
+    try:
+        storage = h5py.File(conn, mode="r")
+    except Exception as e:
+        conn.close()
+        raise e
+    return conn, storage, io_stats
+
+
+class _Handle:
+    """An open zarr store or h5ad file shared by the users of the pool."""
+
+    def __init__(self, key: Optional[tuple], storage, conn, io_stats: IOStats):
+        self.key = key
+        self.storage = storage
+        self.io_stats = io_stats
+        self.n_users = 0
+        self.last_used = time.monotonic()
+        self.closed = False
+        # the version of the stored object and when it was checked
+        self.version: Optional[str] = None
+        self.checked = self.last_used
+        self._conn = conn
+
+    def close(self):
+        if self.closed:
+            return None
+        self.closed = True
+        if self._conn is not None:
+            self.storage.close()
+            self._conn.close()
+
+
+def _open_handle(
+    fs,
+    path: str,
+    suffix: str,
+    max_concurrency: Optional[int] = None,
+    h5ad_cache_options: Optional[dict] = None,
+    key: Optional[tuple] = None,
+) -> _Handle:
+    if suffix == ".h5ad":
+        conn, storage, io_stats = _open_h5ad(fs, path, h5ad_cache_options)
+        return _Handle(key, storage, conn, io_stats)
+    storage = _open_zarr(fs, path, max_concurrency)
+    return _Handle(key, storage, None, storage.chunk_store.io_stats)
+
+
+class _StoragePool:
+    """Process-wide pool of open zarr stores and h5ad files.
+
+    Handles are keyed by the path of the stored object.
+    The version of the object is checked on a miss and, for a pooled handle,
+    at most every `check_interval` seconds, a changed object is opened again.
+    Handles without users are closed if there are more than `max_open`
+    open handles, least recently used first,
+    or if they are unused for more than `idle_timeout` seconds.
+    Objects without a version are not pooled.
+    The writers of this package call `invalidate` for the objects they write.
+
+    Use `open` as a context manager or pair `acquire` with `release`.
+    """
+
+    def __init__(
+        self,
+        max_open: Optional[int] = None,
+        idle_timeout: Optional[float] = None,
+        check_interval: Optional[float] = None,
+    ):
+        self.max_open = max_open if max_open is not None else MAX_OPEN_HANDLES
+        self.idle_timeout = (
+            idle_timeout if idle_timeout is not None else HANDLE_IDLE_TIMEOUT
+        )
+        self.check_interval = (
+            check_interval if check_interval is not None else HANDLE_CHECK_INTERVAL
+        )
+        self.n_opens = 0
+        self.n_reuses = 0
+        self._handles: "OrderedDict[tuple, _Handle]" = OrderedDict()
+        self._lock = Lock()
+
+    def _reuse(self, key: tuple, handle: _Handle) -> _Handle:
+        handle.n_users += 1
+        self._handles.move_to_end(key)
+        self.n_reuses += 1
+        return handle
+
+    def acquire(
+        self,
+        fs,
+        path: str,
+        suffix: str,
+        max_concurrency: Optional[int] = None,
+        h5ad_cache_options: Optional[dict] = None,
+    ) -> _Handle:
+        """Get an open handle, open the stored object if needed."""
+        options = tuple(sorted((h5ad_cache_options or {}).items()))
+        key = (str(fs.protocol), path.rstrip("/"), suffix, max_concurrency, options)
+        with self._lock:
+            self._close_idle()
+            pooled = self._handles.get(key)
+            if pooled is not None:
+                # reuse without checking the version if it was checked recently
+                if time.monotonic() - pooled.checked < self.check_interval:
+                    return self._reuse(key, pooled)
+
+        version = _storage_version(fs, path, suffix)
+        if version is None:
+            handle = _open_handle(fs, path, suffix, max_concurrency, h5ad_cache_options)
+            handle.n_users = 1
+            with self._lock:
+                self.n_opens += 1
+            return handle
+
+        with self._lock:
+            pooled = self._handles.get(key)
+            if pooled is not None and pooled.version == version:
+                pooled.checked = time.monotonic()
+                return self._reuse(key, pooled)
+
+        # other objects can be opened concurrently
+        opened = _open_handle(
+            fs, path, suffix, max_concurrency, h5ad_cache_options, key
+        )
+        opened.version = version
+        with self._lock:
+            pooled = self._handles.get(key)
+            if pooled is not None and pooled.version == version:
+                # opened concurrently by another thread
+                handle = self._reuse(key, pooled)
+            else:
+                if pooled is not None:
+                    # the stored object changed, the old handle is closed
+                    # when it is unused
+                    self._discard(key)
+                handle = opened
+                handle.n_users = 1
+                self._handles[key] = handle
+                self.n_opens += 1
+                self._evict()
+        if handle is not opened:
+            opened.close()
+        return handle
+
+    def invalidate(self, fs, path: str):
+        """Drop the handles of an object which is written or deleted.
+
+        Handles in use are closed when they are released.
+        """
+        protocol, path = str(fs.protocol), path.rstrip("/")
+        with self._lock:
+            for key in [key for key in self._handles if key[:2] == (protocol, path)]:
+                self._discard(key)
+
+    def retain(self, handle: _Handle):
+        """Add a user to a handle which is already acquired."""
+        with self._lock:
+            handle.n_users += 1
+
+    def release(self, handle: _Handle):
+        """Return a handle to the pool."""
+        with self._lock:
+            handle.n_users -= 1
+            handle.last_used = time.monotonic()
+            pooled = handle.key is not None and self._handles.get(handle.key) is handle
+            if handle.n_users == 0 and not pooled:
+                # not pooled or removed from the pool
+                handle.close()
+            self._evict()
+
+    @contextmanager
+    def open(
+        self,
+        fs,
+        path: str,
+        suffix: str,
+        max_concurrency: Optional[int] = None,
+        h5ad_cache_options: Optional[dict] = None,
+    ) -> Iterator[_Handle]:
+        handle = self.acquire(fs, path, suffix, max_concurrency, h5ad_cache_options)
+        try:
+            yield handle
+        finally:
+            self.release(handle)
+
+    def _evict(self):
+        if len(self._handles) <= self.max_open:
+            return None
+        idle = [key for key, handle in self._handles.items() if handle.n_users == 0]
+        for key in idle:
+            if len(self._handles) <= self.max_open:
+                break
+            self._handles.pop(key).close()
+
+    def _discard(self, key: tuple):
+        handle = self._handles.pop(key)
+        if handle.n_users == 0:
+            handle.close()
+
+    def _close_idle(self):
+        if self.idle_timeout is None:
+            return None
+        now = time.monotonic()
+        for key, handle in list(self._handles.items()):
+            if handle.n_users == 0 and now - handle.last_used > self.idle_timeout:
+                self._handles.pop(key).close()
+
+    def close_idle(self):
+        """Close the handles which are unused for more than `idle_timeout`."""
+        with self._lock:
+            self._close_idle()
+
+    def clear(self):
+        """Close all unused handles, handles in use are closed on release."""
+        with self._lock:
+            for key in list(self._handles):
+                self._discard(key)
+
+    def __len__(self) -> int:
+        """The number of pooled handles."""
+        return len(self._handles)
+
+
+STORAGE_POOL = _StoragePool()
+
+
+def _invalidate_storage(filepath, fs=None):
+    """Drop the pooled handles of a written or deleted object."""
+    if fs is None:
+        fs, path = _infer_filesystem(filepath)
+    else:
+        path = str(filepath)
+    STORAGE_POOL.invalidate(fs, path)
+
+
+@contextmanager
+def _open_storage(
+    file: File,
+    max_concurrency: Optional[int] = None,
+    h5ad_cache_options: Optional[dict] = None,
+) -> Iterator[Union[zarr.Group, h5py.File, None]]:
+    """Open the storage of a file with a handle from `STORAGE_POOL`."""
+    if file.suffix not in (".h5ad", ".zarr"):
+        yield None
+        return None
+    file_path = filepath_from_file_or_folder(file)
+    fs, file_path_str = _infer_filesystem(file_path)
+    with STORAGE_POOL.open(
+        fs, file_path_str, file.suffix, max_concurrency, h5ad_cache_options
+    ) as handle:
+        yield handle.storage
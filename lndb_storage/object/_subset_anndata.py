@@ -1,26 +1,56 @@
-from typing import Optional, Union
+import re
+from typing import Iterator, List, Optional, Union
 
 import h5py
 import zarr
 from anndata import AnnData
-from anndata._io.h5ad import read_dataframe_legacy as read_dataframe_legacy_h5
-from anndata._io.specs.methods import _read_partial
-from anndata._io.specs.registry import read_elem, read_elem_partial
-from anndata._io.zarr import read_dataframe_legacy as read_dataframe_legacy_zarr
-from lamindb_setup.dev.upath import infer_filesystem as _infer_filesystem
+from anndata._io.specs.registry import read_elem
+from anndata.compat import _read_attr
 from lnschema_core import File
-from lnschema_core._core import filepath_from_file_or_folder
 
-from ._lazy_field import LazySelector
-
-
-def _read_dataframe(elem: Union[zarr.Array, h5py.Dataset, zarr.Group, h5py.Group]):
-    if isinstance(elem, zarr.Array):
-        return read_dataframe_legacy_zarr(elem)
-    elif isinstance(elem, h5py.Dataset):
-        return read_dataframe_legacy_h5(elem)
+from ._lazy_dataframe import _read_dataframe, _read_dataframe_partial
+from ._lazy_field import LazySelector, _selector_fields
+from ._read_coalesced import _read_elem_coalesced, _read_partial_coalesced
+from ._storage import _open_storage
+
+
+def _query_columns(
+    elem: Union[zarr.Array, h5py.Dataset, zarr.Group, h5py.Group],
+    query: Optional[Union[str, LazySelector]] = None,
+) -> Optional[List[str]]:
+    """Get the dataframe columns needed to evaluate the query.
+
+    Returns `None` if all columns are needed or this can't be determined.
+    """
+    if query is None or isinstance(elem, (zarr.Array, h5py.Dataset)):
+        return None
+    columns = list(_read_attr(elem.attrs, "column-order"))
+    index_names = ("index", _read_attr(elem.attrs, "_index"))
+
+    if hasattr(query, "evaluate"):
+        query_columns = []
+        for field in _selector_fields(query):
+            if field.name in columns:
+                query_columns.append(field.name)
+            elif not (field._as_attr and field.name in index_names):
+                return None
+    else:
+        # a superset of the names referenced in the pandas query string
+        query_columns = re.findall(r"`([^`]+)`", query)
+        query_columns += re.findall(r"[^\W\d]\w*", re.sub(r"`[^`]+`", " ", query))
+    query_columns = [column for column in columns if column in query_columns]
+    if len(query_columns) == len(columns):
+        return None
+    return query_columns
+
+
+def _query_dataframe(df, query: Optional[Union[str, LazySelector]] = None):
+    if query is None:
+        return df
+    elif hasattr(query, "evaluate"):
+        return df[query.evaluate(obj=df)]  # type: ignore
     else:
-        return read_elem(elem)
+        return df.query(query)
 
 
 def _indices(base_indices, select_indices):
@@ -30,80 +60,119 @@ def _indices(base_indices, select_indices):
         return list(base_indices.get_indexer(select_indices))
 
 
+def _select_adata_storage(
+    access: Union[zarr.Group, h5py.File],
+    query_obs: Optional[Union[str, LazySelector]] = None,
+    query_var: Optional[Union[str, LazySelector]] = None,
+) -> Optional[tuple]:
+    selection = []
+    for attr, query in (("obs", query_obs), ("var", query_var)):
+        elem = access[attr]
+        # only the columns referenced in the query are read to evaluate it
+        columns = _query_columns(elem, query)
+        if columns is None:
+            df = _read_dataframe(elem)
+        else:
+            df = _read_dataframe_partial(elem, columns)
+        df_result = _query_dataframe(df, query)
+        if df_result.index.empty:
+            return None
+        idx = _indices(df.index, df_result.index)
+        # read all columns only for the selected rows
+        if columns is not None:
+            df_result = _read_dataframe_partial(elem, rows=idx)
+        selection.append((df_result, idx))
+
+    (obs_result, obs_idx), (var_result, var_idx) = selection
+    return obs_result, var_result, obs_idx, var_idx
+
+
+def _read_adata_storage(
+    access: Union[zarr.Group, h5py.File], obs, var, obs_idx, var_idx
+) -> AnnData:
+    prepare_adata = {}
+    prepare_adata["obs"] = obs
+    prepare_adata["var"] = var
+    X = _read_elem_coalesced(access["X"], indices=(obs_idx, var_idx))
+    prepare_adata["X"] = X
+    if "obsm" in access:
+        obsm = _read_partial_coalesced(access["obsm"], indices=(obs_idx, slice(None)))
+        prepare_adata["obsm"] = obsm
+    if "varm" in access:
+        varm = _read_partial_coalesced(access["varm"], indices=(var_idx, slice(None)))
+        prepare_adata["varm"] = varm
+    if "obsp" in access:
+        obsp = _read_partial_coalesced(access["obsp"], indices=(obs_idx, obs_idx))
+        prepare_adata["obsp"] = obsp
+    if "varp" in access:
+        varp = _read_partial_coalesced(access["varp"], indices=(var_idx, var_idx))
+        prepare_adata["varp"] = varp
+    if "layers" in access:
+        layers = _read_partial_coalesced(access["layers"], indices=(obs_idx, var_idx))
+        prepare_adata["layers"] = layers
+    if "uns" in access:
+        prepare_adata["uns"] = read_elem(access["uns"])
+
+    return AnnData(**prepare_adata)
+
+
 def _subset_adata_storage(
     storage: Union[zarr.Group, h5py.File],
     query_obs: Optional[Union[str, LazySelector]] = None,
     query_var: Optional[Union[str, LazySelector]] = None,
 ) -> Union[AnnData, None]:
-    with storage as access:
-        obs = _read_dataframe(access["obs"])
-        var = _read_dataframe(access["var"])
-
-        if query_obs is not None:
-            if hasattr(query_obs, "evaluate"):
-                obs_result = obs[query_obs.evaluate(obj=obs)]  # type: ignore
-            else:
-                obs_result = obs.query(query_obs)
-        else:
-            obs_result = obs
+    # the storage is closed by its owner, for example the storage pool
+    selection = _select_adata_storage(storage, query_obs, query_var)
+    if selection is None:
+        return None
+    return _read_adata_storage(storage, *selection)
 
-        if query_var is not None:
-            if hasattr(query_var, "evaluate"):
-                var_result = var[query_var.evaluate(obj=var)]  # type: ignore
-            else:
-                var_result = var.query(query_var)
-        else:
-            var_result = var
 
-        if obs_result.index.empty or var_result.index.empty:
-            return None
-
-        obs_idx = _indices(obs.index, obs_result.index)
-        var_idx = _indices(var.index, var_result.index)
-
-        prepare_adata = {}
-        prepare_adata["obs"] = obs_result
-        prepare_adata["var"] = var_result
-        X = read_elem_partial(access["X"], indices=(obs_idx, var_idx))
-        prepare_adata["X"] = X
-        if "obsm" in access:
-            obsm = _read_partial(access["obsm"], indices=(obs_idx, slice(None)))
-            prepare_adata["obsm"] = obsm
-        if "varm" in access:
-            varm = _read_partial(access["varm"], indices=(var_idx, slice(None)))
-            prepare_adata["varm"] = varm
-        if "obsp" in access:
-            obsp = _read_partial(access["obsp"], indices=(obs_idx, obs_idx))
-            prepare_adata["obsp"] = obsp
-        if "varp" in access:
-            varp = _read_partial(access["varp"], indices=(var_idx, var_idx))
-            prepare_adata["varp"] = varp
-        if "layers" in access:
-            layers = _read_partial(access["layers"], indices=(obs_idx, var_idx))
-            prepare_adata["layers"] = layers
-        if "uns" in access:
-            prepare_adata["uns"] = read_elem(access["uns"])
-
-        return AnnData(**prepare_adata)
+def _subset_adata_storage_batches(
+    storage: Union[zarr.Group, h5py.File],
+    query_obs: Optional[Union[str, LazySelector]] = None,
+    query_var: Optional[Union[str, LazySelector]] = None,
+    batch_size: int = 10000,
+) -> Iterator[AnnData]:
+    selection = _select_adata_storage(storage, query_obs, query_var)
+    if selection is None:
+        return None
+    obs, var, obs_idx, var_idx = selection
+    for start in range(0, len(obs), batch_size):
+        stop = start + batch_size
+        if isinstance(obs_idx, slice):
+            batch_idx = slice(start, min(stop, len(obs)))
+        else:
+            batch_idx = obs_idx[start:stop]
+        yield _read_adata_storage(
+            storage, obs.iloc[start:stop], var, batch_idx, var_idx
+        )
 
 
 def _subset_anndata_file(
     file: File,
     query_obs: Optional[Union[str, LazySelector]] = None,
     query_var: Optional[Union[str, LazySelector]] = None,
+    max_concurrency: Optional[int] = None,
+    h5ad_cache_options: Optional[dict] = None,
 ) -> Union[AnnData, None]:
-    file_path = filepath_from_file_or_folder(file)
-    fs, file_path_str = _infer_filesystem(file_path)
-
-    adata: Union[AnnData, None] = None
+    with _open_storage(file, max_concurrency, h5ad_cache_options) as storage:
+        if storage is None:
+            return None
+        return _subset_adata_storage(storage, query_obs, query_var)
 
-    if file.suffix == ".h5ad":
-        with fs.open(file_path_str, mode="rb") as file:
-            storage = h5py.File(file, mode="r")
-            adata = _subset_adata_storage(storage, query_obs, query_var)
-    elif file.suffix == ".zarr":
-        mapper = fs.get_mapper(file_path_str, check=True)
-        storage = zarr.open(mapper, mode="r")
-        adata = _subset_adata_storage(storage, query_obs, query_var)
 
-    return adata
+def _subset_anndata_file_batches(
+    file: File,
+    query_obs: Optional[Union[str, LazySelector]] = None,
+    query_var: Optional[Union[str, LazySelector]] = None,
+    batch_size: int = 10000,
+    max_concurrency: Optional[int] = None,
+    h5ad_cache_options: Optional[dict] = None,
+) -> Iterator[AnnData]:
+    with _open_storage(file, max_concurrency, h5ad_cache_options) as storage:
+        if storage is None:
+            return None
+        yield from _subset_adata_storage_batches(
+            storage, query_obs, query_var, batch_size
+        )